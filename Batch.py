@@ -6,18 +6,22 @@ Batchrunner
 A single class to manage a batch run or parameter sweep of a given model.
 
 """
-import collections
+import collections.abc
 import copy
+import multiprocessing as mp
 from itertools import product, count
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from EV.sweep import check_snapshots, replicate_seeds, reseed_worker, run_model
+
 
 def combinations(*items):
     """
     A small fix to handle dictionary type parameters in cartesian product.
     """
-    prepared = [(item,) if isinstance(item, collections.Mapping) else item
+    prepared = [(item,) if isinstance(item, collections.abc.Mapping) else item
                 for item in items]
     yield from (param for param in product(*prepared))
 
@@ -45,10 +49,15 @@ class batchRunner:
     run. To get step by step data, simply have a reporter store the model's
     entire DataCollector object.
 
+    The runs are generated lazily, one combination of the variable parameters
+    at a time, and the model-level variables are written straight into a
+    table with a row for every run, so no per-run objects are kept.
+
     """
     def __init__(self, model_cls, variable_parameters=None,
             fixed_parameters=None, iterations=1, max_steps=1000,
-            model_reporters=None, agent_reporters=None, display_progress=True):
+            model_reporters=None, agent_reporters=None, display_progress=True,
+            processes=1, snapshot_path=None):
         """ Create a new BatchRunner for a given model with the given
         parameters.
 
@@ -67,7 +76,8 @@ class batchRunner:
                 every instantiated model will be passed constant_parameter=3
                 as a kwarg.
             iterations: The total number of times to run the model for each
-                combination of parameters.
+                combination of parameters. If the parameters include a seed,
+                every iteration is run with its own seed spawned from it.
             max_steps: The upper limit of steps above which each run will be halted
                 if it hasn't halted on its own.
             model_reporters: The dictionary of variables to collect on each run at
@@ -78,9 +88,18 @@ class batchRunner:
                 collected at the level of each agent present in the model at
                 the end of the run.
             display_progress: Display progresss bar with time estimation?
+            processes: The number of processes to spread the runs over, None
+                for one per core. With more than one process the model class
+                and the reporters have to be picklable (no lambdas).
+            snapshot_path: Directory to save the state of the agents at the
+                end of every run to, as <run>.npz (see EV_Model.agentState).
+                The model class needs a saveAgentState method for this.
 
         """
+        check_snapshots(model_cls, snapshot_path)
         self.model_cls = model_cls
+        self.variable_parameters = self.process_parameters(
+            variable_parameters or {})
         self.fixed_parameters = fixed_parameters or {}
         self.iterations = iterations
         self.max_steps = max_steps
@@ -88,13 +107,16 @@ class batchRunner:
         self.model_reporters = model_reporters
         self.agent_reporters = agent_reporters
 
-        if self.model_reporters:
-            self.model_vars = {}
+        # column name -> array with a value for every run, made at the
+        # first result (see store_model_vars)
+        self.model_table = None
 
         if self.agent_reporters:
             self.agent_vars = {}
 
         self.display_progress = display_progress
+        self.processes = processes
+        self.snapshot_path = snapshot_path
 
     def process_parameters(self, params):
         params = copy.deepcopy(params)
@@ -107,24 +129,105 @@ class batchRunner:
             raise VariableParameterError(bad_names)
         return params
 
-    def run_all(self):
-        """ Run the model at all parameter combinations and store results. """
+    @property
+    def total_runs(self):
+        """ The number of runs: every combination of the variable parameters,
+        iterations times. """
+        total = self.iterations
+        for values in self.variable_parameters.values():
+            total *= 1 if isinstance(values, collections.abc.Mapping) else len(values)
+        return total
+
+    def tasks(self):
+        """ Yields the run number and the parameters of every run, one
+        combination of the variable parameters at a time. With a seed
+        parameter and more than one iteration, every iteration gets its own
+        seed spawned from it (like the replicates of EV.sweep.expand). """
+        names = list(self.variable_parameters)
         run_count = count()
-        total_iterations = self.iterations
-        with tqdm(total_iterations, disable=not self.display_progress) as pbar:
+        for values in combinations(*self.variable_parameters.values()):
             kwargs = dict(self.fixed_parameters)
-            model = self.model_cls(**kwargs)
-            self.run_model(model)
-            # Collect and store results:
-            model_key = (next(run_count),)
-            if self.model_reporters:
-                self.model_vars[model_key] = self.collect_model_vars(model)
-            if self.agent_reporters:
-                agent_vars = self.collect_agent_vars(model)
-                for agent_id, reports in agent_vars.items():
-                    agent_key = model_key + (agent_id,)
-                    self.agent_vars[agent_key] = reports
-            pbar.update()
+            kwargs.update(zip(names, values))
+            if kwargs.get("seed") is None or self.iterations == 1:
+                for _ in range(self.iterations):
+                    yield next(run_count), kwargs
+            else:
+                for seed in replicate_seeds(kwargs["seed"], self.iterations):
+                    yield next(run_count), dict(kwargs, seed=seed)
+
+    def run_task(self, task):
+        """ Runs a single model and returns its run number, the values of its
+        variable parameters and the collected variables. With a collect_path
+        parameter, the model writes its time series to the directory of its
+        run number in there. """
+        run, kwargs = task
+        params = {name: kwargs[name] for name in self.variable_parameters}
+        model = run_model(self.model_cls, kwargs, str(run), self.run_model,
+                          self.snapshot_path)
+        model_vars = agent_vars = None
+        if self.model_reporters:
+            model_vars = self.collect_model_vars(model)
+        if self.agent_reporters:
+            agent_vars = self.collect_agent_vars(model)
+        return run, params, model_vars, agent_vars
+
+    def run_all(self):
+        """ Run the model at all parameter combinations and store results. """
+        total_runs = self.total_runs
+        processes = self.processes or mp.cpu_count()
+        if processes > 1:
+            # the runner is sent to every worker once, the tasks one by one
+            pool = mp.Pool(processes, initializer=_init_worker, initargs=(self,))
+            results = pool.imap_unordered(_run_in_worker, self.tasks(),
+                    max(1, total_runs // (4 * processes)))
+        else:
+            pool = None
+            results = map(self.run_task, self.tasks())
+        try:
+            with tqdm(total=total_runs, disable=not self.display_progress) as pbar:
+                for run, params, model_vars, agent_vars in results:
+                    if model_vars is not None:
+                        self.store_model_vars(run, params, model_vars, total_runs)
+                    if agent_vars is not None:
+                        for agent_id, reports in agent_vars.items():
+                            record = dict(params)
+                            record.update(reports)
+                            self.agent_vars[(run, agent_id)] = record
+                    pbar.update()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def store_model_vars(self, run, params, model_vars, total_runs):
+        """ Writes the variable parameters and the model-level variables of a
+        run in its row of the table. A column is typed by its first value
+        (integer, float or object), an integer column becomes a float column
+        for a later float, and an object column if a later value does not
+        fit. """
+        row = dict(params)
+        row.update(model_vars)
+        if self.model_table is None:
+            self.model_table = {"Run": np.arange(total_runs)}
+            for name, value in row.items():
+                kind = np.asarray(value).dtype.kind
+                if kind in "biu":
+                    self.model_table[name] = np.zeros(total_runs, dtype=np.int64)
+                elif kind == "f":
+                    self.model_table[name] = np.full(total_runs, np.nan)
+                else:
+                    self.model_table[name] = np.empty(total_runs, dtype=object)
+        for name, value in row.items():
+            column = self.model_table.get(name)
+            if column is None:
+                column = self.model_table[name] = np.empty(total_runs, dtype=object)
+            if column.dtype.kind == "i" and np.asarray(value).dtype.kind == "f":
+                column = self.model_table[name] = column.astype(float)
+            try:
+                column[run] = value
+            except (TypeError, ValueError, OverflowError):
+                column = self.model_table[name] = column.astype(object)
+                column[run] = value
 
 
     def run_model(self, model):
@@ -139,8 +242,11 @@ class batchRunner:
 
 
     def collect_model_vars(self, model):
-        """ Run reporters and collect model-level variables. """
-        model_vars = {}
+        """ Run reporters and collect model-level variables, the seed of the
+        model and the number of steps it ran (lower than max_steps if it
+        stopped running on its own). """
+        model_vars = {"seed": getattr(model, "seed", None),
+                      "steps": model.schedule.steps}
         for var, reporter in self.model_reporters.items():
             model_vars[var] = reporter(model)
         return model_vars
@@ -162,7 +268,10 @@ class batchRunner:
         collected.
 
         """
-        return self._prepare_report_table(self.model_vars)
+        index_cols = list(self.variable_parameters) + ['Run']
+        rest_cols = sorted(set(self.model_table) - set(index_cols))
+        return pd.DataFrame({name: self.model_table[name]
+                             for name in index_cols + rest_cols})
 
 
     def get_agent_vars_dataframe(self):
@@ -180,16 +289,29 @@ class batchRunner:
         column as a key.
         """
         extra_cols = ['Run'] + (extra_cols or [])
-        index_cols = extra_cols
+        index_cols = list(self.variable_parameters) + extra_cols
 
         records = []
         for param_key, values in vars_dict.items():
-            record = dict(zip(index_cols, param_key))
+            record = dict(zip(extra_cols, param_key))
             record.update(values)
             records.append(record)
 
         df = pd.DataFrame(records)
         rest_cols = set(df.columns) - set(index_cols)
         ordered = df[index_cols + list(sorted(rest_cols))]
-        ordered.sort_values(by='Run', inplace=True)
-        return ordered
+        return ordered.sort_values(by='Run')
+
+
+# the batchRunner of a worker process, set once when the pool starts
+_worker_runner = None
+
+
+def _init_worker(runner):
+    global _worker_runner
+    _worker_runner = runner
+    reseed_worker()
+
+
+def _run_in_worker(task):
+    return _worker_runner.run_task(task)
@@ -2,28 +2,87 @@
 
 import numpy as np
 import math
+from array import array
 from mesa import Agent, Model
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
-from scipy.spatial import distance
+
+from EV.memory import PoleMemory, RecentSightings
+
+
+
+class UsageWindow:
+    """
+    Keeps track of the usage of a charge pole over the last `window` timesteps.
+    A running sum is kept next to a fixed size ring buffer, so the average usage can be read
+    in constant time and the memory per pole does not grow with the length of the run.
+    If full_history is True, every value is also stored in self.history.
+    """
+    __slots__ = ("window", "values", "index", "count", "total", "history")
+
+    def __init__(self, window = 200, full_history = False):
+        self.window = window
+        self.values = array("d", bytes(8 * window))     # plain doubles, no float object per value
+        self.index = 0                  # position in the ring buffer that will be written next
+        self.count = 0                  # number of values currently in the window
+        self.total = 0.0                # running sum of the values in the window
+        self.history = [] if full_history else None
+
+
+    def append(self, value):
+        """
+        Adds a new usage value, replacing the oldest one if the window is full
+        """
+        if self.count == self.window:
+            self.total -= self.values[self.index]
+        else:
+            self.count += 1
+        self.values[self.index] = value
+        self.total += value
+        self.index += 1
+        if self.index == self.window:
+            # once per window the sum is recomputed, so rounding errors can not pile up
+            self.index = 0
+            self.total = sum(self.values)
+        if self.history is not None:
+            self.history.append(value)
+
+
+    def mean(self):
+        """
+        Returns the average usage over the window
+        """
+        if self.count == 0:
+            return np.nan
+        return self.total / self.count
+
+
+    def __len__(self):
+        return self.count
 
 
 
 class Charge_pole(Agent):
     """
     A charge pole agent with 2 free poles. Returns possibly also its usage.
+    The attributes of the charge poles and the EVs are kept in __slots__ instead of a __dict__ per agent, which
+    saves memory for large runs. Mesa's Agent still has a __dict__, so attributes outside the slots also work.
     """
+    usage_window = 200                  # number of timesteps the average usage is taken over
+    initial_free_poles = 2
+    __slots__ = ("unique_id", "model", "pos", "free_poles", "usage", "avg_usage", "stats_slot")
+
     def __init__(self, unique_id, pos, model):
         super().__init__(pos, model)
-        self.initial_free_poles = 2
-        self.free_poles = 2 
-        self.usage = []
+        self.free_poles = self.initial_free_poles
+        self.usage = UsageWindow(self.usage_window, model.usage_history)
         
 
     def step(self):
         self.usage.append( 1- (self.free_poles / self.initial_free_poles))
-        self.avg_usage = np.mean(self.usage[-200:])
+        self.avg_usage = self.usage.mean()
+        self.model.stats.pole_usage[self.stats_slot] = self.avg_usage
 
 
 # Create the Electric Vehicles agents
@@ -31,52 +90,56 @@ class EV_Agent(Agent):
     """ An agent with fixed initial conditions: vision, home_pos, work_pos, initial_bravery and battery_size.
         The agent will travel from home to work and to the shop, and try to make sure the battery does not go to zero.
         It does so by having certain strategies.
+        Its attributes are kept in __slots__, like those of the charge poles.
     """
+    charge_speed = 3                    # the battery increase for every timestep at a charge station
+    shopping_pos = (0, 0)
+    __slots__ = ("unique_id", "model", "pos", "vision", "rng", "max_battery", "battery", "usual_charge_time", "time_charging",
+                 "state", "time_in_state", "how_long_at_work", "how_long_shopping", "how_long_at_home",
+                 "minimum_battery_to_look_for_cp", "critical_battery_limit", "age", "current_strategy", "memory", "sightings",
+                 "offLimits", "prev_target", "prev_target_pos", "attempts_success", "attempts_failed", "initial_bravery",
+                 "home_pos", "work_pos", "center_pos", "target", "target_pos", "direction", "polesInSight", "new_position")
 
     def __init__(self, unique_id, model, vision, home_pos, work_pos, initial_bravery, battery_size = 75):
         super().__init__(unique_id, model)
         self.unique_id = unique_id
         self.vision = vision                                        # taken from a slider input
+        self.rng = model.behaviour_buffer                           # pre-drawn random numbers of the model, for the behaviour of the agents
 
         ## initial values for the battery and time components
-        self.max_battery = np.random.randint(70,80)                 # maximum battery size, differs for different cars is between 70 and 80 kwh (all tesla)
-        self.battery = np.random.randint(50,self.max_battery)       # starting battery 
-        self.usual_charge_time = np.random.normal(25,10) 			# the time period for how long it usually charges
-        self.charge_speed = 3                                       # the battery increase for every timestep at a charge station
+        self.max_battery = self.rng.integers(70,80)                 # maximum battery size, differs for different cars is between 70 and 80 kwh (all tesla)
+        self.battery = self.rng.integers(50,self.max_battery)       # starting battery 
+        self.usual_charge_time = self.rng.normal(25,10) 			# the time period for how long it usually charges
         self.time_charging = 0                                      # initial start
-        self.state = np.random.choice(["working", "shopping", "at_home", "traveling"])	#inital state
-        self.time_in_state = np.random.randint(0,30)	            # initial value to make sure not everyone moves at the same time
-        self.how_long_at_work = np.random.normal(25, 3)             # initial value for time to stay at work
-        self.how_long_shopping = np.random.normal(5, 3)             # initial value for time to stay at the shop
-        self.how_long_at_home = np.random.normal(30, 5)             # if at home, ususally stays for 30 timesteps
-        self.minimum_battery_to_look_for_cp = abs(np.random.normal(30, 10)) # value for when car will look for a CP
-        self.critical_battery_limit = abs(np.random.normal(5,1))    # critical battery limit, will be explained later
+        self.state = self.rng.choice(["working", "shopping", "at_home", "traveling"])	#inital state
+        self.time_in_state = self.rng.integers(0,30)	            # initial value to make sure not everyone moves at the same time
+        self.how_long_at_work = self.rng.normal(25, 3)             # initial value for time to stay at work
+        self.how_long_shopping = self.rng.normal(5, 3)             # initial value for time to stay at the shop
+        self.how_long_at_home = self.rng.normal(30, 5)             # if at home, ususally stays for 30 timesteps
+        self.minimum_battery_to_look_for_cp = abs(self.rng.normal(30, 10)) # value for when car will look for a CP
+        self.critical_battery_limit = abs(self.rng.normal(5,1))    # critical battery limit, will be explained later
         self.age = 0
 
         # only different if smaller battery size
         if battery_size < 70:
-            self.max_battery = np.random.randint(0.9 * battery_size, 1.1 * battery_size)
-            self.battery = np.random.randint(0.75*battery_size, self.max_battery)
-            self.minimum_battery_to_look_for_cp = abs(np.random.normal(0.5*battery_size, 0.1*battery_size))
+            self.max_battery = self.rng.integers(0.9 * battery_size, 1.1 * battery_size)
+            self.battery = self.rng.integers(0.75*battery_size, self.max_battery)
+            self.minimum_battery_to_look_for_cp = abs(self.rng.normal(0.5*battery_size, 0.1*battery_size))
         elif battery_size > 85:
             print("the battery size is too high, for it to be a realistic input")
         
         ## initial values for strategy and memory
         self.current_strategy = 0               # initial value
-        self.pole_count = 0                     # counts the amount of charging_pole encounters (to calculate the 'age' of memories)
-        # different strategies used, which memories count in each strategy
-        self.strategies = [[1,1,1,1,1,1,1,1,1,1],[1,1,1,1,1,0,0,0,0,0],[1,1,1,0,0,0,0,0,0,0],[0,0,0,0,0,0,0,0,0,0]] 
         self.initMemory() 
         #self.possible_steps = []
         self.offLimits = []
         self.prev_target = ""
         self.prev_target_pos = []
-        self.cpf = [0.25, 0.5, 0.75, 1.0]
         self.attempts_success = 0
         self.attempts_failed = 0
         # the amount of tiles it will explore away from the middle between home and work is normally distributed
         # this will be lower the more poles found, and is exponentially distributed.
-        self.initial_bravery = abs(round(np.random.normal(initial_bravery, 5)))
+        self.initial_bravery = abs(round(self.rng.normal(initial_bravery, 5)))
 
         ## initial values for the state and target of the EV
         self.time_in_state = 0
@@ -84,8 +147,7 @@ class EV_Agent(Agent):
         self.pos = home_pos
         self.work_pos = work_pos            # Agent works here
         self.chooseCenterPos()
-        self.shopping_pos = (0, 0)          # Will be set later
-        self.target = np.random.choice(["work", "home", "shop"])             # has one of the targets first
+        self.target = self.rng.choice(["work", "home", "shop"])             # has one of the targets first
         if self.target == "home":
             self.target_pos = home_pos
         elif self.target == "shop":
@@ -102,19 +164,49 @@ class EV_Agent(Agent):
         checking for charge poles, while traveling, and choosing a next step towards the target, before it 
         moves to that position
         """
+        if self.model.profiler is not None:
+            self.profiledMove(self.model.profiler)
+            return
         self.age += 1
+        self.model.stats.age_total += 1
         self.checkTargets()
         if self.state == "traveling":  # if not waiting/charging:
             self.getNeighbourhood()                                             # - find possible moves and register charging poles within vision
             self.chooseNextStep()                                               # - choose next steps based on target and possible moves
             self.moveEV()                                                       # move and use battery
 
+
+    def profiledMove(self, profiler):
+        """
+        The same as move, but times every part of it and counts the poles in sight
+        """
+        clock = profiler.clock
+        self.age += 1
+        self.model.stats.age_total += 1
+        start = clock()
+        self.checkTargets()
+        end = clock()
+        profiler.add("checkTargets", end - start)
+        if self.state == "traveling":
+            start = end
+            self.getNeighbourhood()
+            end = clock()
+            profiler.add("getNeighbourhood", end - start)
+            profiler.count("pole_sightings", len(self.polesInSight))
+            start = end
+            self.chooseNextStep()
+            end = clock()
+            profiler.add("chooseNextStep", end - start)
+            self.moveEV()
+            profiler.add("moveEV", clock() - end)
+
         
     def getNeighbourhood(self):
         """
         Registers possible moves and charging pole positions
         """
         self.polesInSight = self.checkForPoles()  # returns positions of all poles within vision
+        self.sightings.look()
 
         done = False
         neighbors = []    # array of neighbors, saved to prevent updating the memory of the same pole many times in a row, because it is close
@@ -144,48 +236,39 @@ class EV_Agent(Agent):
     
     def neighborMemory(self, neighbors):
         """
-        Adds all new neighboring poles to memory, replacing older memories
+        Adds all new neighboring poles to the recent sightings, the looks older than 3 steps are forgotten
         """
-        self.memory["neighborPoles"] = [neighbors], self.memory["neighborPoles"][:-1]
+        self.sightings.add(neighbors)
 
     
     def checkForPoles(self):  
         """
         Checks for poles within self.vision and returns the positions
         """
-        poles = []
-        neig = self.model.grid.get_neighbors(self.pos,radius = self.vision,moore=True,include_center=True)
-        for agent in neig:
-            if type(agent) == Charge_pole:
-                poles.append(agent.pos)
-        return poles
+        return self.model.pole_index.polesInSight(self.pos, self.vision)
 
     
     def checkIfFree(self,pos):
         """
         Returns the free sockets of a pole at a given position
         """
-        for agent in self.model.grid.get_cell_list_contents(pos):
-            if type(agent) == Charge_pole:
-                return agent.free_poles
+        return self.model.pole_index.freeSockets(pos)
 
     
     def takePlace(self):
         """
         Registers that the car starts charging and a space at the pole is taken
         """
-        for agent in self.model.grid.get_cell_list_contents((self.pos[0],self.pos[1])):
-            if type(agent) == Charge_pole:
-                agent.free_poles = agent.free_poles - 1
+        for agent in self.model.pole_index.polesAt(self.pos):
+            agent.free_poles = agent.free_poles - 1
 
     
     def freePlace(self):
         """
         Registers that charging is complete and a space at the pole is freed up
         """
-        for agent in self.model.grid.get_cell_list_contents((self.pos[0],self.pos[1])):
-            if type(agent) == Charge_pole:
-                agent.free_poles = agent.free_poles + 1
+        for agent in self.model.pole_index.polesAt(self.pos):
+            agent.free_poles = agent.free_poles + 1
 
     
     def inLastPoints(self,pos):
@@ -193,11 +276,7 @@ class EV_Agent(Agent):
         Checks whether given position is in neighborMemory
         to prevent from updating the same pole memory every step
         """
-        for timepoint in self.memory["neighborPoles"]:
-            for coordinate in timepoint:
-                if coordinate == pos:
-                    return True
-        return False
+        return pos in self.sightings
     
     
     def charge(self):
@@ -209,9 +288,11 @@ class EV_Agent(Agent):
         self.time_charging = self.time_charging + 1
         if self.time_charging < self.usual_charge_time or self.battery < self.max_battery:  #self.time_charging < self.usual_charge_time or
             if self.battery < self.max_battery:
+                old_battery = self.battery
                 self.battery += self.charge_speed
                 if self.battery > self.max_battery:
                     self.battery = self.max_battery
+                self.model.stats.changeBattery(old_battery, self.battery)
         else: 
             self.target = self.prev_target
             self.target_pos = self.prev_target_pos
@@ -240,10 +321,12 @@ class EV_Agent(Agent):
                 if self.state == "working":
                     if self.time_in_state < self.how_long_at_work:
                         self.time_in_state += 1
+                        self.model.stats.time_in_state_total += 1
                     else:
+                        self.model.stats.time_in_state_total -= self.time_in_state
                         self.time_in_state = 0
                         self.target = "shop"
-                        self.how_long_shopping = np.random.normal(5, 3)  
+                        self.how_long_shopping = self.rng.normal(5, 3)  
                         self.newRandomPos()  # self.target_pos is selected
                 else:
                     self.state = "working"
@@ -251,10 +334,12 @@ class EV_Agent(Agent):
                 if self.state == "shopping":
                     if self.time_in_state < self.how_long_shopping:
                         self.time_in_state += 1
+                        self.model.stats.time_in_state_total += 1
                     else:
+                        self.model.stats.time_in_state_total -= self.time_in_state
                         self.time_in_state = 0
                         self.target = "home"
-                        self.how_long_at_home = np.random.normal(30, 5)    
+                        self.how_long_at_home = self.rng.normal(30, 5)    
                         self.target_pos = self.home_pos[:]
                         self.setDirection()
                 else:
@@ -269,20 +354,24 @@ class EV_Agent(Agent):
                         self.takePlace()
                         self.charge()
                         self.attempts_success+=1
+                        self.model.stats.attempts_success += 1
                     else:
                         self.offLimits = self.pos
                         self.chooseTargetPole()
                         self.attempts_failed += 1
+                        self.model.stats.attempts_failed += 1
                 else:
                     self.charge()
             else:
                 if self.state == "at_home":
                     if self.time_in_state < self.how_long_at_home:
                         self.time_in_state += 1
+                        self.model.stats.time_in_state_total += 1
                     else:
+                        self.model.stats.time_in_state_total -= self.time_in_state
                         self.time_in_state = 0
                         self.target = "work"
-                        self.how_long_at_work = np.random.normal(25, 3)  
+                        self.how_long_at_work = self.rng.normal(25, 3)  
                         self.target_pos = self.work_pos[:]
                         self.setDirection()
                 else:
@@ -327,18 +416,18 @@ class EV_Agent(Agent):
         """
 
 
-        polesInMemory = len(self.memory)- 5 # initial memory with strategies is 5, every pole added in memory is one extra
+        polesInMemory = len(self.memory)
 
         
         if polesInMemory == 0:
-            bravery = round(np.random.exponential(self.initial_bravery))
+            bravery = round(self.rng.exponential(self.initial_bravery))
         else:
-            bravery = round(np.random.exponential(self.initial_bravery/polesInMemory)) # exponential function to get random shopping position distance
+            bravery = round(self.rng.exponential(self.initial_bravery/polesInMemory)) # exponential function to get random shopping position distance
 
         if self.model.open == False:
-            newPos = [np.random.choice([np.max([self.center_pos[0] - bravery, 0]),np.min([self.center_pos[0] + bravery, self.model.grid.width - 1])]),np.random.choice([np.max([self.center_pos[1] - bravery, 0]),np.min([self.center_pos[1] + bravery, self.model.grid.height - 1])])]
+            newPos = [self.rng.choice([max(self.center_pos[0] - bravery, 0),min(self.center_pos[0] + bravery, self.model.grid.width - 1)]),self.rng.choice([max(self.center_pos[1] - bravery, 0),min(self.center_pos[1] + bravery, self.model.grid.height - 1)])]
         else:
-            newPos = [np.random.choice(np.arange(self.center_pos[0] - bravery,self.center_pos[0] + bravery + 1)), np.random.choice(np.arange(self.center_pos[1] - bravery,self.center_pos[1] + bravery + 1,1))]
+            newPos = [self.rng.integers(self.center_pos[0] - bravery,self.center_pos[0] + bravery + 1), self.rng.integers(self.center_pos[1] - bravery,self.center_pos[1] + bravery + 1)]
             for i in range(2):
                 if newPos[i] < 0:
                     newPos[i] = newPos[i] + self.model.grid.width
@@ -352,18 +441,15 @@ class EV_Agent(Agent):
         """
         This function makes sure that one step is taken towards the target, and making this alos possible for a toroidal grid
         """
-        difference = []
-        for i in range(2):
-            difference.append(abs(self.target_pos[i]-self.pos[i]))
-            if difference[i] > 0.5 * self.model.grid.width and self.model.open == True:
-                difference[i] = self.model.grid.width - difference[i]
+        difference = self.model.geometry.differences(self.pos, self.target_pos)
         new_position = [0,0]
+        # a target off the grid (see newRandomPos) can give a negative difference over a zero one, which is never taken
         if difference[0] > difference[1]:
             new_position[0] = self.pos[0] + self.direction[0]
             if difference[1] == 0:
                 new_position[1] = self.pos[1] 
             else: 
-                if np.random.rand() < difference[1]/difference[0]:
+                if difference[0] != 0 and self.rng.random() < difference[1]/difference[0]:
                     new_position[1] = self.pos[1] + self.direction[1]
                 else:
                     new_position[1] = self.pos[1] 
@@ -372,7 +458,7 @@ class EV_Agent(Agent):
             if difference[0] == 0:
                 new_position[0] = self.pos[0]
             else: 
-                if np.random.rand() < difference[0]/difference[1]:
+                if difference[1] != 0 and self.rng.random() < difference[0]/difference[1]:
                     new_position[0] = self.pos[0] + self.direction[0]
                 else:
                     new_position[0] = self.pos[0]
@@ -391,20 +477,7 @@ class EV_Agent(Agent):
         """
         This function sets the direction of the EV
         """
-        difference = (self.target_pos[0]-self.pos[0] ,self.target_pos[1]-self.pos[1])
-        direction = [0,0]
-        for i in range(2):
-            if difference[i] > 0:
-                if self.model.open == True and difference[i] > 0.5 * self.model.grid.width: # again assuming square grid
-                    direction[i] = -1
-                else:
-                    direction[i] = 1
-            elif difference[i] < 0:
-                if self.model.open == True and difference[i] < - 0.5 * self.model.grid.width: # again assuming square grid
-                    direction[i] = 1
-                else: 
-                    direction[i] = -1
-        self.direction = direction
+        self.direction = self.model.geometry.directions(self.pos, self.target_pos)     # the other way around if that is shorter on an open grid
     
     
     def moveEV(self):
@@ -417,79 +490,29 @@ class EV_Agent(Agent):
     
     def initMemory(self):
         """
-        Initiates memory dictionary and score dictionary, and for each strategy creates a (neutral) memory
+        Initiates the memory of poles and strategies (see PoleMemory), and the memory of recently seen poles
         """
-        self.memory = {}
-        self.scores = {}
-        for i in range(len(self.strategies)):
-            self.memory[i+1]=[[0,0,0,0,0,0,0,0,0,0],[0,0,0,0,0,0,0,0,0,0]]
-        self.memory["neighborPoles"] = [[0],[0],[0]]
-        self.updateStrategies()
+        self.memory = PoleMemory()
+        self.sightings = RecentSightings()
 
     
     def updateMemory(self,succes,pos):
         """
-        Saves new memories
+        Saves new memories, which also count for the current strategy if the pole is the target
         """
-        self.pole_count += 1
-        if pos in self.memory:
-            self.memory[pos] = [[succes]+self.memory[pos][0][:-1],[self.pole_count]+self.memory[pos][1][:-1]]
-        else:
-            self.memory[pos] = [[succes]+[0,0,0,0,0,0,0,0,0],[self.pole_count]+[0,0,0,0,0,0,0,0,0]]
+        if self.model.profiler is not None:
+            self.model.profiler.count("memory_updates")
+        strategy = 0
         if self.current_strategy > 0 and pos[0] == self.target_pos[0] and pos[1] == self.target_pos[1]:
-            self.memory[self.current_strategy] = [[succes]+self.memory[self.current_strategy][0][:-1],[self.pole_count]+self.memory[self.current_strategy][1][:-1]]
-            self.updateStrategies()
-        self.updateScores(pos)
-    
-        
-    def updateStrategies(self):
-        """
-        Updates cumulative probability function based on new memories for strategy, with a minimum of -10, and maximum of 10.
-        """
-        prev=0
-        self.cpf = []
-        for i in range(len(self.strategies)):
-            next = (sum(self.ageCompensation(i+1)) + 10) # Make positive, nonzero number.
-            if next == 0:
-                next = 0.000001
-            self.cpf.append(prev + next)
-            prev=self.cpf[i]
-        
-        for i in range(len(self.cpf)):
-            self.cpf[i]  = self.cpf[i] / self.cpf[len(self.strategies)-1]
+            strategy = self.current_strategy
+        self.memory.update(succes, pos, strategy)
     
-   
-    def updateScores(self,pos):
-        """
-        Updates scores when memory changes
-        """
-        if pos not in self.scores:
-            self.scores[pos] = [0,0,0,0]
-        age = self.ageCompensation(pos)
-        for i in range(len(self.strategies)):
-            temp = 0
-            for j in range(len(age)):
-                temp += self.strategies[i][j]*age[j]
-            self.scores[pos][i] = temp
 
-    
     def chooseStrategy(self):
         """
         Strategy chosen based on cumulative probability function
         """
-        r = np.random.rand()
-        for i in range(len(self.cpf)):
-            if r<self.cpf[i]:
-                return i+1
-
-    def ageCompensation(self,key):
-        """
-        Compensates the age of memories by formula y = score * 0.98 ^ (current pole_count - pole_count attached to memory)
-        """
-        result=[]
-        for i in range(len(self.memory[key][1])):
-            result.append( self.memory[key][0][i] * math.pow(0.98,self.pole_count-self.memory[key][1][i]))
-        return result
+        return self.memory.chooseStrategy(self.rng.random())
 
     def chooseTargetPole(self):
         """
@@ -498,6 +521,8 @@ class EV_Agent(Agent):
         The charge pole is then chosen by taking the highest score
                 
         """
+        if self.model.profiler is not None:
+            self.model.profiler.count("target_selections")
         if self.target != "searching" and self.target != "charge_pole":
             self.prev_target = self.target 
             self.prev_target_pos = self.target_pos
@@ -507,70 +532,98 @@ class EV_Agent(Agent):
         
         if len(options) == 0:
             self.target = "searching"
-            self.target_pos = (np.random.randint(0,self.model.grid.width), np.random.randint(0, self.model.grid.height))
+            self.target_pos = (self.rng.integers(0,self.model.grid.width), self.rng.integers(0, self.model.grid.height))
             self.setDirection()
         else:
-            OptionScores = []
-
-            for i in np.arange(np.shape(options)[0]):
-                dist = abs(self.pos[0]-self.pos[1]) + abs(options[i][0][0]-options[i][0][1])
-                a = 1 / 100
-                w_dist = (-a * dist) + 1
-                w_batt = (-a * self.battery)+1
-                new_CP_score = (w_dist - (w_batt * (dist/100)))* options[i][1]
-
-                OptionScores.append(new_CP_score)
-
-            ind_highest_score = np.argmax(OptionScores)
-            self.target_pos = options[ind_highest_score][0]
+            self.target_pos = self.memory.bestOption(options, self.pos, self.battery, self.current_strategy)
             self.setDirection()
             self.target = "charge_pole"
 
     
     def checkOptions(self):
         """
-        Goes through known poles and checks if they're options as targets, by checking their score and if they
-        are not available ('off limit')
+        Returns the rows in memory of the known poles that are options as targets: the poles that are not 'off limit'
+        and can be reached with the battery left
         """
-        
-        num=0
-        options = []
-        for key in self.scores:
-            options.append([key,self.scores[key][self.current_strategy-1]])
-            num += 1
-
-        found = 0
-        if num>0:
-            for opt in options:
-                if opt[0] in self.offLimits:
-                    options.remove(opt)
-                else: 
-                    distance = (abs(self.pos[0] - opt[0][0]),abs(self.pos[1] - opt[0][1]))
-                    battery_required = (max(distance)+0.41421356237*min(distance)) * 0.3 # I'm not sure this is correct. I want it to be the maximum battery use for a 'straight' step
-                    if battery_required > self.battery:
-                        options.remove(opt)
-        return options
+        # battery_required: I'm not sure this is correct. I want it to be the maximum battery use for a 'straight' step
+        battery_required = self.model.geometry.travelCostMany(self.pos, self.memory.coordinates())
+        return self.memory.optionRows(battery_required <= self.battery, self.offLimits)
             
    
     def use_battery(self):
         """
          Function to decrease battery with the distance, considering one tile is 1 km
          """
-        dist = (distance.euclidean(self.pos, self.new_position))
-        if dist > 0.5*self.model.grid.width:
-            dist = self.model.grid.width - dist
+        dist = self.model.geometry.stepCost(self.pos, self.new_position)
 
         # average battery cost per km is between 0.08 and 0.3 kwh
-        cost = dist * ((0.30 - 0.08) * np.random.random_sample() + 0.08)
+        cost = dist * ((0.30 - 0.08) * self.rng.random() + 0.08)
+        self.model.stats.changeBattery(self.battery, self.battery - cost)
         self.battery -= cost
     
+    def idleSteps(self):
+        """
+        Returns the number of coming timesteps in which the EV only counts time: at work, at the shop or at home
+        until time_in_state reaches how long it stays, or while charging with a full battery until usual_charge_time
+        has passed (the battery does not change in these steps, so the model statistics stay right).
+        """
+        if self.target_pos[0] != self.pos[0] or self.target_pos[1] != self.pos[1]:
+            return 0
+        if self.battery < self.minimum_battery_to_look_for_cp and self.target != "charge_pole" and self.target != "searching":
+            return 0
+        if self.target == "work":
+            if self.state == "working":
+                return max(0, math.ceil(self.how_long_at_work - self.time_in_state))
+        elif self.target == "shop":
+            if self.state == "shopping":
+                return max(0, math.ceil(self.how_long_shopping - self.time_in_state))
+        elif self.target == "charge_pole":
+            if self.state == "charging" and self.time_charging > 0 and self.battery >= self.max_battery:
+                # charging is complete at the first timestep with time_charging >= usual_charge_time
+                return max(0, math.ceil(self.usual_charge_time - self.time_charging) - 1)
+        elif self.target != "searching":
+            if self.state == "at_home":
+                return max(0, math.ceil(self.how_long_at_home - self.time_in_state))
+        return 0
+
+
+    def skipSteps(self, n):
+        """
+        Catches up with n skipped timesteps (see idleSteps) at once, the model statistics counted them already
+        """
+        self.age += n
+        if self.state == "charging":
+            self.time_charging += n
+        else:
+            self.time_in_state += n
+
+
+    def sleep(self, steps):
+        """
+        Lets the schedule skip the EV for the coming steps, the model statistics count its time meanwhile
+        """
+        self.model.schedule.sleep(self, steps)
+        self.model.stats.sleep(self.state != "charging")
+
+
+    def wake(self, n):
+        """
+        Called by the schedule when the EV is woken up after n skipped steps
+        """
+        self.skipSteps(n)
+        self.model.stats.wake(self.state != "charging")
+
+
     def step(self):
         """
         The step function, enables the agents to move and act in the enviroment during a timestep.
+        With skip_idle, an EV that is parked sleeps through the steps in which it only counts time.
         """
         if self.battery <= 0:
-            self.model.grid._remove_agent(self.pos, self)
-            self.model.schedule.remove(self)
-            self.model.current_EVs -= 1
+            self.model.removeEV(self)
         if self.battery > 0:
             self.move()
+            if self.state != "traveling" and self.model.schedule.skip_idle:
+                idle = self.idleSteps()
+                if idle > 0:
+                    self.sleep(idle)
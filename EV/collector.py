@@ -0,0 +1,157 @@
+### collector.py
+
+import json
+import os
+import struct
+import numpy as np
+import pandas as pd
+
+
+HEADER_SIZE = 128           # bytes of the .npy header, so it can be rewritten in place when rows are added
+
+
+def npy_header(dtype, rows):
+    """
+    Returns a .npy (version 1.0) header of HEADER_SIZE bytes for a 1d array of rows values
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(np.dtype(dtype)), rows)
+    header = header.ljust(HEADER_SIZE - 10 - 1) + "\n"
+    return np.lib.format.magic(1, 0) + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class ArrayCollector:
+    """
+    Collects model reporters like Mesa's DataCollector, but into a preallocated NumPy array of chunk rows
+    (a column per reporter and one with the step) instead of Python lists. The reporters have to return
+    numbers, None is stored as nan.
+    With a path, every full chunk is appended to one .npy file per column in that directory, so the memory
+    of a run stays flat however long it is, and the columns can be memory-mapped with load_columns. close()
+    writes the last rows, EV_Model.finish calls it at the end of a run.
+    Without a path the chunks are kept in memory.
+    """
+    def __init__(self, model_reporters, path = None, chunk = 512):
+        self.model_reporters = dict(model_reporters)
+        self.names = list(self.model_reporters)
+        self.path = path
+        self.chunk = chunk
+        self.buffer = np.empty((chunk, len(self.names)))
+        self.steps = np.empty(chunk, dtype=np.int64)
+        self.filled = 0                 # rows of the buffer in use
+        self.rows = 0                   # rows flushed
+        self.chunks = []                # (steps, values) of the flushed chunks, without a path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            for name, dtype in self.dtypes().items():
+                with open(self.file(name), "wb") as f:
+                    f.write(npy_header(dtype, 0))
+            with open(os.path.join(path, "columns.json"), "w") as f:
+                json.dump({"columns": ["step"] + self.names}, f)
+
+
+    def dtypes(self):
+        dtypes = {"step": np.int64}
+        dtypes.update((name, np.float64) for name in self.names)
+        return dtypes
+
+
+    def file(self, name):
+        return os.path.join(self.path, name + ".npy")
+
+
+    def collect(self, model):
+        """
+        Collects all the reporters for the model in the next row
+        """
+        row = self.buffer[self.filled]
+        for j, reporter in enumerate(self.model_reporters.values()):
+            value = reporter(model)
+            row[j] = np.nan if value is None else value
+        self.steps[self.filled] = model.schedule.steps
+        self.filled += 1
+        if self.filled == self.chunk:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Appends the rows in the buffer to the files (or to the chunks in memory) and empties the buffer
+        """
+        if self.filled == 0:
+            return
+        steps = self.steps[:self.filled]
+        values = self.buffer[:self.filled]
+        if self.path is None:
+            self.chunks.append((steps.copy(), values.copy()))
+        else:
+            rows = self.rows + self.filled
+            columns = [("step", steps)] + [(name, values[:, j]) for j, name in enumerate(self.names)]
+            for name, column in columns:
+                with open(self.file(name), "r+b") as f:
+                    f.seek(0, os.SEEK_END)
+                    f.write(np.ascontiguousarray(column, dtype=self.dtypes()[name]).tobytes())
+                    f.seek(0)
+                    f.write(npy_header(self.dtypes()[name], rows))
+        self.rows += self.filled
+        self.filled = 0
+
+
+    def close(self):
+        self.flush()
+
+
+    def columns(self):
+        """
+        Returns every column (step and the reporters) with all rows collected so far, the flushed rows
+        of a path are memory-mapped
+        """
+        pending = {"step": self.steps[:self.filled]}
+        pending.update((name, self.buffer[:self.filled, j]) for j, name in enumerate(self.names))
+        if self.path is not None:
+            flushed = load_columns(self.path)
+            if self.filled == 0:
+                return flushed
+        else:
+            flushed = {"step": [chunk[0] for chunk in self.chunks]}
+            flushed.update((name, [chunk[1][:, j] for chunk in self.chunks]) for j, name in enumerate(self.names))
+            flushed = {name: np.concatenate(parts) if parts else pending[name][:0] for name, parts in flushed.items()}
+        return {name: np.concatenate((flushed[name], pending[name])) for name in pending}
+
+
+    @property
+    def model_vars(self):
+        """
+        The collected values by reporter, like DataCollector.model_vars (used by the charts of the server)
+        """
+        columns = self.columns()
+        return {name: columns[name] for name in self.names}
+
+
+    def get_model_vars_dataframe(self):
+        """
+        Returns the collected values as a DataFrame with a column per reporter, like DataCollector
+        """
+        return pd.DataFrame(self.model_vars, columns=self.names)
+
+
+def load_columns(path, mmap = True):
+    """
+    Returns the columns written by an ArrayCollector to path, memory-mapped (read only) unless mmap is False
+    """
+    with open(os.path.join(path, "columns.json")) as f:
+        names = json.load(f)["columns"]
+    return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None) for name in names}
+
+
+def load_dataframe(paths, mmap = True):
+    """
+    Returns the columns of one or more ArrayCollector directories as one DataFrame, with the directory of every row
+    in the run column
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    frames = []
+    for path in paths:
+        frame = pd.DataFrame(load_columns(path, mmap))
+        frame.insert(0, "run", os.path.basename(os.path.normpath(path)))
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
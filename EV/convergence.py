@@ -0,0 +1,51 @@
+### convergence.py
+
+from collections import deque
+import numpy as np
+
+
+class ConvergenceMonitor:
+    """
+    Stops a model once its key reporters have settled. Every `every` steps the reporters are read, and once
+    there are two full windows of window steps the mean of the last window is compared with the mean of the
+    window before it. If they differ by at most tolerance for every reporter (relative to the value, or absolute
+    for values below 1, so usage and percentages are compared in absolute terms) the model stops running and
+    the step is kept in converged_at.
+    Reporters that keep growing during a run (Total_attempts, or Average_lifespan when few EVs run out of battery)
+    never settle, they should not be monitored, and their end of run value depends on the step the run stopped at.
+    """
+    def __init__(self, reporters, window = 250, tolerance = 0.01, every = 10):
+        self.reporters = reporters              # name -> model reporter function
+        self.window = max(1, window // every)   # samples per window
+        self.tolerance = tolerance
+        self.every = every
+        self.samples = {name: deque(maxlen=2 * self.window) for name in reporters}
+        self.converged_at = None
+
+
+    def settled(self, values):
+        """
+        Returns whether the last window of samples is within the tolerance of the window before it
+        """
+        values = np.asarray(values, dtype=float)
+        old = values[:self.window].mean()
+        new = values[self.window:].mean()
+        if np.isnan(old) or np.isnan(new):
+            return False
+        return abs(new - old) <= self.tolerance * max(abs(old), abs(new), 1)
+
+
+    def check(self, model):
+        """
+        Samples the reporters (every `every` steps) and stops the model if all of them have settled
+        """
+        steps = model.schedule.steps
+        if self.converged_at is not None or steps % self.every != 0:
+            return
+        for name, reporter in self.reporters.items():
+            self.samples[name].append(reporter(model))
+        for samples in self.samples.values():
+            if len(samples) < 2 * self.window or not self.settled(samples):
+                return
+        self.converged_at = steps
+        model.running = False
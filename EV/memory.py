@@ -0,0 +1,205 @@
+### memory.py
+
+import numpy as np
+from collections import deque
+
+
+# different strategies used, which memories count in each strategy (most recent memory first)
+STRATEGIES = np.array([[1,1,1,1,1,1,1,1,1,1],[1,1,1,1,1,0,0,0,0,0],[1,1,1,0,0,0,0,0,0,0],[0,0,0,0,0,0,0,0,0,0]])
+MEMORY_LENGTH = STRATEGIES.shape[1]
+
+# the memories are stored in ring buffers; ROLLED_STRATEGIES[head] is the strategy matrix lined up with a
+# ring buffer whose most recent memory is at position head
+ROLLED_STRATEGIES = np.array([np.roll(STRATEGIES, head, axis=1) for head in range(MEMORY_LENGTH)])
+
+
+class PoleMemory:
+    """
+    Memory of a single EV: for every known charge pole, and for every strategy, the last 10 successes (1)
+    and failures (-1) together with the pole_count at which they were remembered. Both are kept in NumPy
+    ring buffers (poles x 10 and strategies x 10), so a new memory is a single write and the score of a pole
+    for all strategies is one matrix-vector product.
+    Memories lose weight with their age: y = score * 0.98 ^ (current pole_count - pole_count attached to memory),
+    the factors are taken from a table shared by all EVs.
+    """
+    decay = 0.98 ** np.arange(1024)         # decay[k] = 0.98 ^ k, grows when needed
+    __slots__ = ("index", "positions", "coords", "success", "stamps", "heads", "scores", "strategy_success",
+                 "strategy_stamps", "strategy_heads", "pole_count", "cpf")
+
+    def __init__(self, capacity = 4):
+        self.index = {}                     # pole position -> row in the arrays
+        self.positions = []                 # pole position of every row
+        self.coords = np.zeros((capacity, 2), dtype=np.int64)     # the same positions as an array
+        self.success = np.zeros((capacity, MEMORY_LENGTH))
+        self.stamps = np.zeros((capacity, MEMORY_LENGTH), dtype=np.int64)
+        self.heads = np.zeros(capacity, dtype=np.int64)
+        self.scores = np.zeros((capacity, len(STRATEGIES)))
+        self.strategy_success = np.zeros((len(STRATEGIES), MEMORY_LENGTH))
+        self.strategy_stamps = np.zeros((len(STRATEGIES), MEMORY_LENGTH), dtype=np.int64)
+        self.strategy_heads = np.zeros(len(STRATEGIES), dtype=np.int64)
+        self.pole_count = 0                 # counts the amount of charging_pole encounters (to calculate the 'age' of memories)
+        self.updateStrategies()
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    def __contains__(self, pos):
+        return (pos[0], pos[1]) in self.index
+
+
+    @classmethod
+    def decayFactors(cls, n):
+        """
+        Returns the decay table, making sure it holds at least n + 1 factors
+        """
+        if n >= len(cls.decay):
+            cls.decay = 0.98 ** np.arange(2 * n)
+        return cls.decay
+
+
+    def update(self, succes, pos, strategy = 0):
+        """
+        Saves a new memory of the pole at pos. If strategy > 0 the memory also counts for that strategy,
+        after which the cumulative probability function is updated. Updates the score of the pole.
+        """
+        self.pole_count += 1
+        pos = (pos[0], pos[1])
+        row = self.index.get(pos)
+        if row is None:
+            row = self.addPole(pos)
+        head = (self.heads[row] - 1) % MEMORY_LENGTH
+        self.heads[row] = head
+        self.success[row, head] = succes
+        self.stamps[row, head] = self.pole_count
+        if strategy > 0:
+            s = strategy - 1
+            strategy_head = (self.strategy_heads[s] - 1) % MEMORY_LENGTH
+            self.strategy_heads[s] = strategy_head
+            self.strategy_success[s, strategy_head] = succes
+            self.strategy_stamps[s, strategy_head] = self.pole_count
+            self.updateStrategies()
+        decay = self.decayFactors(self.pole_count)
+        self.scores[row] = ROLLED_STRATEGIES[head] @ (self.success[row] * decay[self.pole_count - self.stamps[row]])
+
+
+    def addPole(self, pos):
+        """
+        Adds an empty memory for a new pole and returns its row
+        """
+        row = len(self.positions)
+        if row == len(self.success):
+            capacity = 2 * row
+            self.success = np.resize(self.success, (capacity, MEMORY_LENGTH))
+            self.stamps = np.resize(self.stamps, (capacity, MEMORY_LENGTH))
+            self.coords = np.resize(self.coords, (capacity, 2))
+            self.heads = np.resize(self.heads, capacity)
+            self.scores = np.resize(self.scores, (capacity, len(STRATEGIES)))
+        self.success[row] = 0
+        self.stamps[row] = 0
+        self.heads[row] = 0
+        self.scores[row] = 0
+        self.coords[row] = pos
+        self.index[pos] = row
+        self.positions.append(pos)
+        return row
+
+
+    def updateStrategies(self):
+        """
+        Updates cumulative probability function based on new memories for strategy, with a minimum of -10, and maximum of 10.
+        """
+        decay = self.decayFactors(self.pole_count)
+        weights = (self.strategy_success * decay[self.pole_count - self.strategy_stamps]).sum(axis=1) + 10   # Make positive, nonzero number.
+        weights[weights == 0] = 0.000001
+        cpf = np.cumsum(weights)
+        self.cpf = cpf / cpf[-1]
+
+
+    def chooseStrategy(self, r):
+        """
+        Strategy chosen based on cumulative probability function, for a uniform random number r
+        """
+        return int(np.searchsorted(self.cpf, r, side='right')) + 1
+
+
+    def coordinates(self):
+        """
+        Returns a (poles, 2) array with the positions of the known poles
+        """
+        return self.coords[:len(self.positions)]
+
+
+    def optionRows(self, reachable, off_limits = ()):
+        """
+        Returns the rows of the known poles that are options as targets: reachable (a boolean array over the
+        known poles) and not off limits
+        """
+        options = reachable.copy()
+        for pos in off_limits:
+            # off_limits can also be a position itself, whose coordinates never match a pole
+            row = self.index.get(pos) if type(pos) is tuple else None
+            if row is not None:
+                options[row] = False
+        return np.flatnonzero(options)
+
+
+    def bestOption(self, rows, pos, battery, strategy):
+        """
+        Scores the poles in rows for the given strategy, adding weight to distance & battery, and returns the
+        position of the pole with the highest score (the first one if there are more)
+        """
+        coords = self.coords[rows]
+        dist = abs(pos[0] - pos[1]) + np.abs(coords[:, 0] - coords[:, 1])
+        a = 1 / 100
+        w_dist = (-a * dist) + 1
+        w_batt = (-a * battery) + 1
+        scores = (w_dist - (w_batt * (dist / 100))) * self.scores[rows, strategy - 1]
+        return self.positions[rows[np.argmax(scores)]]
+
+
+
+class RecentSightings:
+    """
+    The poles an EV newly saw during its last 3 looks around (steps while traveling), so it does not update the memory
+    of the same pole every step while passing by. Every look is a frozenset of positions in a deque, and a count of
+    every position over all looks in the deque makes the lookup O(1). Looks are numbered, so an EV that did not see
+    anything for a while (the EVFleet only looks at EVs with a pole in sight) can catch up with look(n).
+    """
+    depth = 3
+    __slots__ = ("looks", "counts", "number")
+
+    def __init__(self):
+        self.looks = deque()        # (number of the look, frozenset of positions), the last depth looks and the current one
+        self.counts = {}            # position -> number of looks in the deque it is in
+        self.number = 0             # number of the current look
+
+
+    def __contains__(self, pos):
+        return (pos[0], pos[1]) in self.counts
+
+
+    def look(self, number = None):
+        """
+        Starts a new look (or look number), forgetting the looks that are no longer within the last 3
+        """
+        self.number = self.number + 1 if number is None else number
+        while self.looks and self.looks[0][0] <= self.number - self.depth - 1:
+            for pos in self.looks.popleft()[1]:
+                if self.counts[pos] == 1:
+                    del self.counts[pos]
+                else:
+                    self.counts[pos] -= 1
+
+
+    def add(self, positions):
+        """
+        Adds the poles newly seen in the current look
+        """
+        if not positions:
+            return
+        seen = frozenset((pos[0], pos[1]) for pos in positions)
+        self.looks.append((self.number, seen))
+        for pos in seen:
+            self.counts[pos] = self.counts.get(pos, 0) + 1
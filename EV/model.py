@@ -4,69 +4,82 @@ import matplotlib.pyplot as plt
 import numpy as np
 import random
 import math
+from operator import attrgetter
 from pyDOE import *
 from mesa import Agent, Model
 from mesa.time import RandomActivation
-from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
 from scipy.spatial import distance
 
 from EV.agents import EV_Agent, Charge_pole
+from EV.collector import ArrayCollector
+from EV.convergence import ConvergenceMonitor
+from EV.profiling import StepProfiler, PROFILE_REPORTERS
+from EV.rng import RandomBuffer
 from EV.schedule import RandomActivationByBreed
+from EV.space import PoleIndex, EmptyCellGrid, GridGeometry
+from EV.stats import ModelStats
+from EV.vectorized import EVFleet, STATES
 
 
 
+def count_EVs(model):
+    """
+    Data collector function to output the number of EVs currently in the model
+    """
+    if model.fleet is not None:
+        return model.fleet.count
+    return model.schedule.get_breed_count(EV_Agent)
+
 def mean_all_battery(model):
     """
     Data collector function to ouput the mean of all battery
     """
-
-    agent_battery_levels = [agent.battery for agent in model.schedule.agents if type(agent) is EV_Agent]
-    #x = sorted(agent_wealths)
-    
-    B = np.mean(agent_battery_levels)
-    return B
+    stats = model.stats
+    if stats.EVs == 0:
+        return np.nan
+    return stats.battery_total / stats.EVs
 
 def lowest_25_percent(model):
     """
-    Data collector function to ouput the 25th percentil of all batteries
+    Data collector function to ouput the 25th percentil of all batteries (estimated with a histogram of 0.1 kWh bins)
     """
-    agent_battery_levels = [agent.battery for agent in model.schedule.agents if type(agent) is EV_Agent]
-    #x = sorted(agent_wealths)
-    return  np.percentile(agent_battery_levels, 25)
+    return model.stats.battery_sketch.percentile(25)
 
 def specific_battery(model):
     """
     Data collector function to ouput the battery of a single EV
     """
-    for agent in model.schedule.agents:
-        if agent.unique_id == 10 and type(agent) is EV_Agent:
-            return agent.battery
+    if model.fleet is not None:
+        battery = model.fleet.values("battery")[model.fleet.values("unique_id") == 10]
+        if len(battery) > 0:
+            return battery[0]
+        return None
+    if model.tracked_EV is not None:
+        return model.tracked_EV.battery
 
 def time_in_state(model):
-    agent_time_in_state = [agent.time_in_state for agent in model.schedule.agents if type(agent) is EV_Agent]
-    return np.mean(agent_time_in_state)
+    stats = model.stats
+    if stats.EVs == 0:
+        return np.nan
+    return stats.time_in_state_total / stats.EVs
 
 def count_agents(model):  
     N = model.num_agents
     return N
 
 def avg_usage(model):
-    CP_usage = [agent.avg_usage for agent in model.schedule.agents if type(agent) is Charge_pole]
-    return np.mean(CP_usage)
+    return np.mean(model.stats.usage())
 
 def high_usage(model):
-    CP_usage = [agent.avg_usage for agent in model.schedule.agents if type(agent) is Charge_pole]
-
-    return np.percentile(np.array(CP_usage), 75)
+    return np.percentile(model.stats.usage(), 75)
 
 def low_usage(model):
-    CP_usage = [agent.avg_usage for agent in model.schedule.agents if type(agent) is Charge_pole]
-    return np.percentile(np.array(CP_usage), 25)
+    return np.percentile(model.stats.usage(), 25)
 
 def percentageFailed(model):
-    failed = sum([agent.attempts_failed for agent in model.schedule.agents if type(agent) is EV_Agent])
-    succeeded = sum([agent.attempts_success for agent in model.schedule.agents if type(agent) is EV_Agent])
+    failed = model.stats.attempts_failed
+    succeeded = model.stats.attempts_success
     if failed > 0:
         percentage = failed / (failed + succeeded)
         return percentage
@@ -75,13 +88,35 @@ def percentageFailed(model):
     
 
 def totalAttempts(model):
-    failed = sum([agent.attempts_failed for agent in model.schedule.agents if type(agent) is EV_Agent])
-    succeeded = sum([agent.attempts_success for agent in model.schedule.agents if type(agent) is EV_Agent])
-    return failed+succeeded
+    return model.stats.attempts_failed + model.stats.attempts_success
 
 def averageLifespan(model):
-    age = np.mean([agent.age for agent in model.schedule.agents if type(agent) is EV_Agent])
-    return age
+    stats = model.stats
+    if stats.EVs == 0:
+        return np.nan
+    return stats.age_total / stats.EVs
+
+# all model reporters that can be collected every step, by name
+MODEL_REPORTERS = {"Avg_Battery": mean_all_battery,
+                   "Usage": avg_usage,
+                   "High_Usage":high_usage,
+                   "Low_Usage":low_usage,
+                   "Total_attempts": totalAttempts,
+                   "Percentage_failed": percentageFailed,
+                   "Average_lifespan": averageLifespan,
+                   "lower25": lowest_25_percent,
+                   "timeInState": time_in_state,
+                   "unique_battery":specific_battery,
+                   "Num_agents": count_agents,
+                   "EVs": count_EVs}
+
+# the EV attributes in the agent state (see EV_Model.agentState) and their types, the state is a code of STATES
+EV_STATE_COLUMNS = {"unique_id": np.int64, "battery": np.float64, "age": np.int64, "attempts_success": np.int64,
+                    "attempts_failed": np.int64, "pos": np.int64, "state": np.int8}
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+# the model reporters watched by the convergence monitor, the reporters that settle during a run
+CONVERGENCE_REPORTERS = ["Usage", "Percentage_failed", "Avg_Battery"]
 
   # gives back a list of n points in a circle of radius r
 def PointsInCircum(r,n=100):
@@ -89,18 +124,38 @@ def PointsInCircum(r,n=100):
 
 # Create the model
 class EV_Model(Model):
-    def __init__(self, N = 50, width = 20, height = 20, n_poles = 10, vision = 10, grid_positions = "random", initial_bravery = 10, battery_size = 25, open_grid = True):
+    def __init__(self, N = 50, width = 20, height = 20, n_poles = 10, vision = 10, grid_positions = "random", initial_bravery = 10, battery_size = 25, open_grid = True, usage_history = False, engine = "agents", collect_every = 1, reporters = None, skip_idle = False, profile = False, convergence_window = 0, convergence_tolerance = 0.01, collector = "lists", collect_path = None, seed = None):
+        # every run has its own random streams, spawned from the seed: one for placing homes, work places and poles,
+        # one for the behaviour of the EVs and one for the order of the schedule. Without a seed fresh entropy is used,
+        # the seed of the run is kept in self.seed so it can be reproduced
+        seed_sequence = np.random.SeedSequence(seed)
+        self.seed = seed_sequence.entropy
+        self.placement_rng, self.behaviour_rng, self.schedule_rng = [np.random.default_rng(s) for s in seed_sequence.spawn(3)]
+        # the EV agents draw single numbers, these come from blocks drawn at once from the behaviour stream
+        self.behaviour_buffer = RandomBuffer(self.behaviour_rng)
         self.battery_size = battery_size
+        self.usage_history = usage_history      # if True, charge poles keep their full usage history next to the 200 step window
         self.initial_bravery = initial_bravery
         self.num_agents = N
         self.open = open_grid
+        # the grid keeps an index of its empty cells, so find_empty stays O(1) on large and full grids
         if self.open == True:
-            self.grid = MultiGrid(width, height, True) 
+            self.grid = EmptyCellGrid(width, height, True, self.placement_rng) 
         else:
-            self.grid = MultiGrid(width, height, False)
-        self.schedule = RandomActivationByBreed(self)
+            self.grid = EmptyCellGrid(width, height, False, self.placement_rng)
+        # distances, directions and battery costs on the grid, with wrapping on an open grid (like EV_Agent, only open_grid == True)
+        self.geometry = GridGeometry(width, height, self.open == True)
+        # with profile, the time spent in every phase of a step is kept (see profileSummary), otherwise profiler is None
+        self.profiler = StepProfiler() if profile else None
+        # with skip_idle, EVs that are only counting time (working, shopping, at home, or charging with a full battery) are not stepped
+        self.schedule = RandomActivationByBreed(self, skip_idle, self.schedule_rng, self.profiler)
+        self.pole_index = PoleIndex(self.grid)
+        self.stats = ModelStats()           # aggregates used by the model reporters, updated by the agents
+        self.tracked_EV = None              # the EV with unique_id 10, reported by specific_battery
         self.vision = vision
         self.grid_size = width
+        # "agents" steps every EV as an EV_Agent, "vectorized" keeps all EVs in the arrays of an EVFleet
+        self.fleet = EVFleet(self) if engine == "vectorized" else None
 
         # adds CPs based on the input grid position
         if grid_positions == "circle":
@@ -110,9 +165,7 @@ class EV_Model(Model):
             for i, coord in enumerate(circle_list):
                 new_coord = (coord[0] + center_grid[0],coord[1] + center_grid[1])
 
-                charge_pole = Charge_pole(i, new_coord, self)
-                self.grid.place_agent(charge_pole, new_coord)
-                self.schedule.add(charge_pole)
+                self.addPole(Charge_pole(i, new_coord, self), new_coord)
                 
         elif grid_positions == "big circle":
             center_grid = (int(width/2), int(height/2))
@@ -120,30 +173,25 @@ class EV_Model(Model):
             for i, coord in enumerate(circle_list):
                 new_coord = (coord[0] + center_grid[0],coord[1] + center_grid[1])
 
-                charge_pole = Charge_pole(i, new_coord, self)
-                self.grid.place_agent(charge_pole, new_coord)
-                self.schedule.add(charge_pole)
+                self.addPole(Charge_pole(i, new_coord, self), new_coord)
 
         elif grid_positions == "random":
             for i in range(int(N*n_poles)):
                 # Add the agent to a random grid cell
                 empty_coord = self.grid.find_empty()
-                charge_pole = Charge_pole(i,empty_coord, self)
-                self.grid.place_agent(charge_pole, empty_coord)
-                self.schedule.add(charge_pole)
+                self.addPole(Charge_pole(i,empty_coord, self), empty_coord)
 
         elif grid_positions == "LHS":
+            # pyDOE only draws from the global numpy state, which is seeded from the placement stream for the design
+            global_state = np.random.get_state()
+            np.random.seed(self.placement_rng.integers(2**32))
             coord_list =  np.round(lhs(2, samples = int(N*n_poles), criterion = "m")*(self.grid_size-1))
+            np.random.set_state(global_state)
             for i in range(int(N*n_poles)):
                 coord = tuple((int(coord_list[i][0]), int(coord_list[i][1])))
-                if self.grid.is_cell_empty(coord):
-                    charge_pole = Charge_pole(i,coord, self)
-                    self.grid.place_agent(charge_pole, coord)
-                else:
-                    empty_coord = self.grid.find_empty()
-                    charge_pole = Charge_pole(i,empty_coord, self)
-                    self.grid.place_agent(charge_pole, empty_coord)
-                self.schedule.add(charge_pole)
+                if not self.grid.is_cell_empty(coord):
+                    coord = self.grid.find_empty()
+                self.addPole(Charge_pole(i,coord, self), coord)
 
 
 
@@ -151,50 +199,217 @@ class EV_Model(Model):
             
 
         # Create EV agents
-        for i in range(self.num_agents):
-            
-            # Add the agent to a random empty grid cell
-            home_pos = self.grid.find_empty()
-            work_pos = self.grid.find_empty()
-
-            EV = EV_Agent(i, self, self.vision, home_pos, work_pos, initial_bravery, battery_size)
-            self.schedule.add(EV)
-            
-            self.grid.place_agent(EV, home_pos)
-            self.totalEVs = i
-
-        self.datacollector = DataCollector(
-            agent_reporters={},
-            model_reporters= {"Avg_Battery": mean_all_battery,
-                              "Usage": avg_usage,
-                              "High_Usage":high_usage,
-                               "Low_Usage":low_usage,
-                              "Total_attempts": totalAttempts,
-                              "Percentage_failed": percentageFailed,
-                              "Average_lifespan": averageLifespan,
-                              "lower25": lowest_25_percent,
-                              "timeInState": time_in_state,
-                              "unique_battery":specific_battery,
-                              "Num_agents": count_agents,
-                              "EVs": lambda m: m.schedule.get_breed_count(EV_Agent)})
+        if self.fleet is not None:
+            homes = []
+            works = []
+            for i in range(self.num_agents):
+                homes.append(self.grid.find_empty())
+                works.append(self.grid.find_empty())
+            self.fleet.add(range(self.num_agents), homes, works)
+            self.totalEVs = self.num_agents - 1
+        else:
+            for i in range(self.num_agents):
+                
+                # Add the agent to a random empty grid cell
+                home_pos = self.grid.find_empty()
+                work_pos = self.grid.find_empty()
+
+                EV = EV_Agent(i, self, self.vision, home_pos, work_pos, initial_bravery, battery_size)
+                self.addEV(EV, home_pos)
+                self.totalEVs = i
+
+        # the datacollector collects the given reporters (all of MODEL_REPORTERS if None) every collect_every steps,
+        # a collect_every of 0 turns off the collection every step (batch runs only use the end of the run)
+        self.collect_every = collect_every
+        # a profiled model also collects the times and counts of the profiler
+        # with collector "arrays" the values are kept in NumPy arrays (ArrayCollector) instead of lists, and with
+        # a collect_path they are written to .npy files in that directory as the run goes
+        if reporters is None:
+            reporters = list(MODEL_REPORTERS) + (list(PROFILE_REPORTERS) if profile else [])
+        all_reporters = dict(MODEL_REPORTERS, **PROFILE_REPORTERS)
+        model_reporters = {name: all_reporters[name] for name in reporters}
+        if collector == "arrays":
+            self.datacollector = ArrayCollector(model_reporters, collect_path)
+        else:
+            self.datacollector = DataCollector(
+                agent_reporters={},
+                model_reporters= model_reporters)
         
 
+        # with a convergence_window (in steps), the model stops running once the CONVERGENCE_REPORTERS have settled
+        # (see ConvergenceMonitor), the step it stopped at is kept in converged_at
+        self.monitor = None
+        if convergence_window:
+            self.monitor = ConvergenceMonitor({name: MODEL_REPORTERS[name] for name in CONVERGENCE_REPORTERS},
+                                              convergence_window, convergence_tolerance)
+
         self.running = True
         self.current_EVs = self.totalEVs
             
     def step(self):
+        if self.profiler is not None:
+            self.profiledStep()
+            return
+        self.schedule.step()
+        if self.fleet is not None:
+            self.fleet.step()
+        self.endStep()
+
+
+    def endStep(self):
+        """
+        The end of a step, after the agents have moved: counts the step of the sleeping EVs, collects the data,
+        replaces the EVs that ran out of battery and checks for convergence
+        """
+        self.stats.tick()
+        if self.collect_every and self.schedule.steps % self.collect_every == 0:
+            self.datacollector.collect(self)
+        self.stableAgents()
+        if self.monitor is not None:
+            self.monitor.check(self)
+
+
+    def finish(self):
+        """
+        The end of a run: writes the rows still buffered by an ArrayCollector and brings the agents that
+        the skip-idle schedule put to sleep up to date, so the reporters and the agent state are final
+        """
+        if isinstance(self.datacollector, ArrayCollector):
+            self.datacollector.close()
+        self.schedule.settle()
+
+
+    @property
+    def converged_at(self):
+        """
+        The step at which the convergence monitor stopped the model, None if it did not (or there is no monitor)
+        """
+        if self.monitor is None:
+            return None
+        return self.monitor.converged_at
+
+
+    def profiledStep(self):
+        """
+        The same as step, but with the time of every phase added to the profiler
+        """
+        clock = self.profiler.clock
+        start = clock()
         self.schedule.step()
-        self.datacollector.collect(self)
+        end = clock()
+        self.profiler.add("schedule", end - start)
+        if self.fleet is not None:
+            start = end
+            self.fleet.step()
+            end = clock()
+            self.profiler.add("fleet", end - start)
+        self.stats.tick()
+        if self.collect_every and self.schedule.steps % self.collect_every == 0:
+            start = end
+            self.datacollector.collect(self)
+            end = clock()
+            self.profiler.add("collect", end - start)
         self.stableAgents()
+        self.profiler.add("respawn", clock() - end)
+        if self.monitor is not None:
+            self.monitor.check(self)
+
+
+    def profileSummary(self):
+        """
+        Returns the table of the time spent per phase and the counted events, for a model made with profile=True
+        """
+        if self.profiler is None:
+            return "not profiled, make the model with profile=True"
+        return self.profiler.summary()
+
+
+    def agentState(self):
+        """
+        Returns the state of all EVs (the EV_STATE_COLUMNS, with pos as an (n, 2) array) and of all charge poles
+        (pole_pos, pole_usage and pole_free) as typed NumPy arrays, read in one pass over the agents
+        (or straight from the fleet arrays), together with the step
+        """
+        self.schedule.settle()
+        if self.fleet is not None:
+            state = {name: self.fleet.values(name).astype(dtype) for name, dtype in EV_STATE_COLUMNS.items()}
+        else:
+            EVs = self.schedule.breeds.get(EV_Agent, ())
+            columns = list(zip(*map(attrgetter(*EV_STATE_COLUMNS), EVs))) or [()] * len(EV_STATE_COLUMNS)
+            state = {name: np.array(column, dtype=dtype) for (name, dtype), column in zip(EV_STATE_COLUMNS.items(), columns)
+                     if name != "state"}
+            state["pos"] = state["pos"].reshape(-1, 2)
+            state["state"] = np.array([STATE_CODES[s] for s in columns[-1]], dtype=np.int8)
+        poles = self.stats.poles
+        state["pole_pos"] = np.array([pole.pos for pole in poles], dtype=np.int64).reshape(-1, 2)
+        state["pole_usage"] = self.stats.usage().copy()
+        state["pole_free"] = np.array([pole.free_poles for pole in poles], dtype=np.int64)
+        state["step"] = np.int64(self.schedule.steps)
+        return state
+
+
+    def saveAgentState(self, path):
+        """
+        Saves the agentState to an .npz file, read it back with np.load(path)
+        """
+        np.savez(path, **self.agentState())
+
+
+    def addPole(self, charge_pole, pos):
+        """
+        Places a charge pole on the grid, adds it to the schedule and registers it in the pole index
+        """
+        self.grid.place_agent(charge_pole, pos)
+        self.schedule.add(charge_pole)
+        self.pole_index.add(charge_pole)
+        self.stats.addPole(charge_pole)
+
+
+    def removePole(self, charge_pole):
+        """
+        Takes a charge pole out of the grid, the schedule and the pole index
+        """
+        self.pole_index.remove(charge_pole)
+        self.stats.removePole(charge_pole)
+        self.grid._remove_agent(charge_pole.pos, charge_pole)
+        self.schedule.remove(charge_pole)
+
+
+    def addEV(self, EV, home_pos):
+        """
+        Places an EV agent at its home, adds it to the schedule and registers it in the model statistics
+        """
+        self.grid.place_agent(EV, home_pos)
+        self.schedule.add(EV)
+        self.stats.addEV(EV.battery)
+        if EV.unique_id == 10 and self.tracked_EV is None:
+            self.tracked_EV = EV
+
+
+    def removeEV(self, EV):
+        """
+        Removes an EV agent (with an empty battery) from the grid, the schedule and the model statistics
+        """
+        self.grid._remove_agent(EV.pos, EV)
+        self.schedule.remove(EV)
+        self.stats.removeEV(EV.battery, EV.age, EV.time_in_state, EV.attempts_success, EV.attempts_failed)
+        self.current_EVs -= 1
+        if EV is self.tracked_EV:
+            self.tracked_EV = None
 
 
     def stableAgents(self):
+        if self.fleet is not None:
+            ids = range(self.totalEVs, self.totalEVs + max(self.num_agents - self.current_EVs, 0))
+            self.fleet.add(ids, [self.grid.find_empty() for i in ids], [self.grid.find_empty() for i in ids])
+            self.totalEVs += len(ids)
+            self.current_EVs += len(ids)
+            return
         while self.current_EVs < self.num_agents:
             home_pos = self.grid.find_empty()
             work_pos = self.grid.find_empty()
             EV = EV_Agent(self.totalEVs, self, self.vision, home_pos, work_pos,self.initial_bravery, self.battery_size)
-            self.grid.place_agent(EV, home_pos)
-            self.schedule.add(EV)
+            self.addEV(EV, home_pos)
             self.totalEVs += 1
             self.current_EVs += 1
             
@@ -0,0 +1,85 @@
+### profiling.py
+
+import time
+from collections import defaultdict
+from functools import partial
+
+
+# the phases timed by the profiler: the parts of EV_Model.step, the breeds of the schedule and the parts of EV_Agent.move
+# (the vectorized engine times the same parts of EVFleet.step)
+MODEL_PHASES = ["schedule", "fleet", "collect", "respawn"]
+BREED_PHASES = ["EV_Agent", "Charge_pole"]
+MOVE_PHASES = ["checkTargets", "getNeighbourhood", "chooseNextStep", "moveEV"]
+# the events counted by the profiler
+EVENTS = ["pole_sightings", "memory_updates", "target_selections"]
+
+
+class StepProfiler:
+    """
+    Keeps the cumulative wall time and number of calls of every phase of a run, and counts events
+    (poles seen, memory updates and choices of a target pole). A model only has a profiler if it is
+    made with profile=True, the agents and the schedule check for None before timing anything.
+    """
+    def __init__(self):
+        self.clock = time.perf_counter
+        self.times = defaultdict(float)     # phase -> seconds
+        self.calls = defaultdict(int)       # phase -> number of calls
+        self.counts = defaultdict(int)      # event -> number of times it happened
+
+
+    def add(self, phase, seconds, calls = 1):
+        self.times[phase] += seconds
+        self.calls[phase] += calls
+
+
+    def count(self, event, n = 1):
+        self.counts[event] += n
+
+
+    def reset(self):
+        self.times.clear()
+        self.calls.clear()
+        self.counts.clear()
+
+
+    def summary(self):
+        """
+        Returns a table of the time per phase (with its share of the time of the schedule, the fleet or the
+        move of the EVs it belongs to) and the counted events
+        """
+        lines = ["%-18s %10s %10s %12s %7s" % ("phase", "calls", "total s", "per call us", "share")]
+        groups = [(MODEL_PHASES, sum(self.times[phase] for phase in MODEL_PHASES)),
+                  (BREED_PHASES, self.times["schedule"]),
+                  (MOVE_PHASES, self.times["EV_Agent"] or self.times["fleet"])]
+        for phases, total in groups:
+            for phase in phases:
+                if self.calls[phase] == 0:
+                    continue
+                lines.append("%-18s %10d %10.3f %12.2f %6.1f%%" % (phase, self.calls[phase], self.times[phase],
+                             1e6 * self.times[phase] / self.calls[phase], 100 * self.times[phase] / total if total else 0))
+        for event in EVENTS:
+            lines.append("%-18s %10d" % (event, self.counts[event]))
+        return "\n".join(lines)
+
+
+def phase_time(model, phase):
+    """
+    Model reporter of the seconds spent in a phase so far, nan if the model is not profiled
+    """
+    if model.profiler is None:
+        return float("nan")
+    return model.profiler.times[phase]
+
+
+def event_count(model, event):
+    """
+    Model reporter of the number of times an event happened so far, nan if the model is not profiled
+    """
+    if model.profiler is None:
+        return float("nan")
+    return model.profiler.counts[event]
+
+
+# model reporters of the profiler, by name (partials of module functions, so they can be sent to the sweep workers)
+PROFILE_REPORTERS = dict([("Time_" + phase, partial(phase_time, phase=phase)) for phase in MODEL_PHASES + BREED_PHASES + MOVE_PHASES] +
+                         [(event.capitalize(), partial(event_count, event=event)) for event in EVENTS])
@@ -0,0 +1,113 @@
+### replicates.py
+
+import os
+import numpy as np
+
+from EV.model import EV_Model
+from EV.store import run_key
+from EV.sweep import replicate_seeds
+from EV.vectorized import EVFleet
+
+
+class ReplicateBatch:
+    """
+    Runs replicates of EV_Model with the same parameters in lockstep. Every replicate is a vectorized EV_Model
+    with its own seed (the seeds of the replicates in sweep.expand, so replicate r gives the same results as
+    the sweep run of replicate r), but the EVs of all replicates are kept in one merged EVFleet and moved in one
+    pass per step. The poles, statistics, data collection and random streams stay with the models, so every
+    replicate has its own reporters.
+    A replicate whose model stops running (see the convergence monitor) is no longer stepped.
+        batch = ReplicateBatch(8, seed=20180202, N=300, width=80, height=80, n_poles=0.1, vision=2)
+        batch.run(2500)
+        rows = batch.rows({"Usage": avg_usage})
+    """
+    def __init__(self, replicates = 8, seed = None, **params):
+        if params.get("engine", "vectorized") != "vectorized":
+            raise ValueError("the replicates of a ReplicateBatch use the vectorized engine")
+        self.params = params
+        self.seeds = replicate_seeds(seed, replicates)
+        self.models = [EV_Model(**self.modelParams(r)) for r in range(replicates)]
+        self.fleet = EVFleet.merge(self.models)
+        self.steps = 0
+        self.running = True
+
+
+    def replicateParams(self, r):
+        """
+        Returns the parameters of replicate r, the same as those of its task in sweep.expand
+        """
+        if self.seeds[r] is None:
+            return dict(self.params)
+        return dict(self.params, seed=self.seeds[r])
+
+
+    def modelParams(self, r):
+        """
+        Returns the arguments of the model of replicate r, which writes its time series to the directory
+        of its key in collect_path (if given), like sweep.run_task
+        """
+        params = self.replicateParams(r)
+        kwargs = dict(params, engine="vectorized")
+        if params.get("collect_path") is not None:
+            kwargs["collect_path"] = os.path.join(params["collect_path"], run_key(params, r))
+        return kwargs
+
+
+    def step(self):
+        """
+        Steps the models that are still running: their poles, then the EVs of all of them, then the end of their step
+        """
+        running = [model for model in self.models if model.running]
+        self.fleet.paused[:] = [not model.running for model in self.models]
+        for model in running:
+            model.schedule.step()
+        self.fleet.step()
+        for model in running:
+            model.endStep()
+        self.steps += 1
+        self.running = any(model.running for model in self.models)
+
+
+    def run(self, max_steps):
+        """
+        Steps until max_steps, or until all models stopped running
+        """
+        while self.running and self.steps < max_steps:
+            self.step()
+        for model in self.models:
+            model.finish()
+
+
+    def saveAgentStates(self, path):
+        """
+        Saves the agent state of every replicate to <key>.npz in path, like sweep.run_task
+        """
+        os.makedirs(path, exist_ok=True)
+        for r, model in enumerate(self.models):
+            model.saveAgentState(os.path.join(path, run_key(self.replicateParams(r), r) + ".npz"))
+
+
+    def report(self, reporter):
+        """
+        Returns the value of a model reporter for every replicate
+        """
+        return np.array([reporter(model) for model in self.models])
+
+
+    def rows(self, model_reporters, run = 0):
+        """
+        Returns a row for every replicate, the same as the rows of sweep.run_task (so they can be added to a ResultStore)
+        """
+        rows = []
+        for replicate, model in enumerate(self.models):
+            params = self.replicateParams(replicate)
+            row = dict(params)
+            row["Run"] = run
+            row["Replicate"] = replicate
+            row["Key"] = run_key(params, replicate)
+            row["seed"] = model.seed
+            row["Steps"] = model.schedule.steps
+            for name, reporter in model_reporters.items():
+                row[name] = reporter(model)
+            rows.append(row)
+        return rows
@@ -0,0 +1,62 @@
+### rng.py
+
+import numpy as np
+
+
+class RandomBuffer:
+    """
+    Hands out single random numbers from blocks that are drawn from a numpy Generator in one go, one block per
+    distribution (uniform, standard normal and standard exponential). Drawing a single value from numpy costs
+    about as much as drawing a few hundred, so the EV agents take their values from here instead.
+    The other distributions are made from these: normal(loc, scale) = loc + scale * z, and so on.
+    """
+    def __init__(self, rng = None, block = 4096):
+        if rng is None or not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng)
+        self.rng = rng
+        self.block = block
+        self.uniforms = []
+        self.normals = []
+        self.exponentials = []
+
+
+    def reseed(self, seed = None):
+        """
+        Starts over with a new Generator for the seed, dropping the values that were drawn already
+        """
+        self.rng = np.random.default_rng(seed)
+        self.uniforms = []
+        self.normals = []
+        self.exponentials = []
+
+
+    def random(self):
+        """ Uniform in [0, 1) """
+        if not self.uniforms:
+            self.uniforms = self.rng.random(self.block).tolist()
+        return self.uniforms.pop()
+
+
+    def normal(self, loc = 0.0, scale = 1.0):
+        if not self.normals:
+            self.normals = self.rng.standard_normal(self.block).tolist()
+        return loc + scale * self.normals.pop()
+
+
+    def exponential(self, scale = 1.0):
+        if not self.exponentials:
+            self.exponentials = self.rng.standard_exponential(self.block).tolist()
+        return scale * self.exponentials.pop()
+
+
+    def integers(self, low, high = None):
+        """ Integer in [low, high), or in [0, low) if no high is given """
+        if high is None:
+            low, high = 0, low
+        low = int(low)
+        return low + int(self.random() * (int(high) - low))
+
+
+    def choice(self, options):
+        """ One of the options, all equally likely """
+        return options[int(self.random() * len(options))]
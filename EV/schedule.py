@@ -1,9 +1,37 @@
+import heapq
 import random
 from collections import defaultdict
+from itertools import count
 
 from mesa.time import RandomActivation
 
 
+class AgentRegistry:
+    '''
+    Ordered set of agents (a dict without values), so agents can be added and removed in O(1) and are
+    always iterated in the order they were added, whatever was removed before.
+    Agents are keyed by the agent object itself and not by unique_id, since those are not unique
+    (charge poles use their position, and the last EV gets the id of the one before it).
+    '''
+    def __init__(self):
+        self.index = {}         # agent -> None, in the order the agents were added
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __contains__(self, agent):
+        return agent in self.index
+
+    def add(self, agent):
+        self.index[agent] = None
+
+    def remove(self, agent):
+        self.index.pop(agent, None)
+
+
 class RandomActivationByBreed(RandomActivation):
     '''
     A scheduler which activates each type of agent once per step, in random
@@ -13,12 +41,35 @@ class RandomActivationByBreed(RandomActivation):
     default behavior for an ABM.
 
     Assumes that all agents have a step() method.
+
+    The agents are kept in AgentRegistry objects, so adding and removing an agent is O(1). Every step
+    a shuffled copy of a breed (in the order the agents were added) is run, agents removed during the
+    step are skipped and agents added during the step are first run in the next one.
+
+    If skip_idle is True, agents that know they will only count time for a number of coming steps can
+    put themselves to sleep for those steps with sleep(agent, steps). They are woken up from a priority
+    queue, when wake(n) lets them catch up with the n skipped steps in one go (also when they are removed
+    while sleeping). settle() brings all sleeping agents up to date with skipSteps(n), without waking them,
+    for code that reads their attributes.
+
+    The order is shuffled with rng (a numpy Generator), or with the random module if no rng is given.
+    If a profiler (EV.profiling.StepProfiler) is given, the time and number of agent steps of every breed are kept.
     '''
     agents_by_breed = defaultdict(list)
 
-    def __init__(self, model):
+    def __init__(self, model, skip_idle=False, rng=None, profiler=None):
         super().__init__(model)
+        self.profiler = profiler
+        self.rng = rng if rng is not None else random
+        self.registry = AgentRegistry()
+        self.agents = self.registry
+        self.breeds = {}            # breed -> AgentRegistry of its agents
         self.agents_by_breed = defaultdict(list)
+        self.skip_idle = skip_idle
+        self.sleeping = {}          # agent -> first step it has not caught up with
+        self.wake_queue = []        # heap of (step to wake up at, order, agent)
+        self.wake_order = count()
+        self.settled_at = 0
 
     def add(self, agent):
         '''
@@ -28,21 +79,24 @@ class RandomActivationByBreed(RandomActivation):
             agent: An Agent to be added to the schedule.
         '''
 
-        self.agents.append(agent)
+        self.registry.add(agent)
         agent_class = type(agent)
-        self.agents_by_breed[agent_class].append(agent)
+        if agent_class not in self.breeds:
+            self.breeds[agent_class] = self.agents_by_breed[agent_class] = AgentRegistry()
+        self.breeds[agent_class].add(agent)
 
     def remove(self, agent):
         '''
-        Remove all instances of a given agent from the schedule.
+        Remove a given agent from the schedule.
         '''
 
-        while agent in self.agents:
-            self.agents.remove(agent)
-
+        self.registry.remove(agent)
         agent_class = type(agent)
-        while agent in self.agents_by_breed[agent_class]:
-            self.agents_by_breed[agent_class].remove(agent)
+        if agent_class in self.breeds:
+            self.breeds[agent_class].remove(agent)
+        since = self.sleeping.pop(agent, None)
+        if since is not None:
+            agent.wake(self.steps - since)
 
     def step(self, by_breed=True):
         '''
@@ -53,27 +107,79 @@ class RandomActivationByBreed(RandomActivation):
                       the next one.
         '''
         if by_breed:
-            for agent_class in self.agents_by_breed:
-                self.step_breed(agent_class)
-            self.steps += 1
-            self.time += 1
+            if self.skip_idle:
+                self.wake()
+            for agent_class in list(self.breeds):
+                if self.profiler is None:
+                    self.step_breed(agent_class)
+                else:
+                    start = self.profiler.clock()
+                    stepped = self.step_breed(agent_class)
+                    self.profiler.add(agent_class.__name__, self.profiler.clock() - start, stepped)
         else:
-            super().step()
+            agents = list(self.registry)
+            self.rng.shuffle(agents)
+            for agent in agents:
+                if agent in self.registry:
+                    agent.step()
+        self.steps += 1
+        self.time += 1
 
     def step_breed(self, breed):
         '''
-        Shuffle order and run all agents of a given breed.
+        Shuffle order and run all agents of a given breed. The whole breed is shuffled, also the
+        sleeping agents, so skip_idle does not change the order of the agents that are run.
 
         Args:
             breed: Class object of the breed to run.
+
+        Returns the number of agents that were run.
         '''
-        agents = self.agents_by_breed[breed]
-        random.shuffle(agents)
+        if breed not in self.breeds:
+            return 0
+        registry = self.breeds[breed]
+        agents = list(registry)
+        self.rng.shuffle(agents)
+        sleeping = self.sleeping
+        stepped = 0
         for agent in agents:
+            if agent not in registry or agent in sleeping:
+                continue        # removed earlier in this step, or sleeping
             agent.step()
+            stepped += 1
+        return stepped
+
+    def sleep(self, agent, steps):
+        '''
+        Lets the schedule skip an agent for the coming steps, called by the agent at the end of its step.
+        '''
+        self.sleeping[agent] = self.steps + 1
+        heapq.heappush(self.wake_queue, (self.steps + 1 + steps, next(self.wake_order), agent))
+
+    def wake(self):
+        '''
+        Wakes up the agents that have to be stepped again this step, after catching up with the skipped steps.
+        '''
+        while self.wake_queue and self.wake_queue[0][0] <= self.steps:
+            agent = heapq.heappop(self.wake_queue)[2]
+            since = self.sleeping.pop(agent, None)
+            if since is not None:
+                agent.wake(self.steps - since)
+
+    def settle(self):
+        '''
+        Brings the sleeping agents up to date with the steps done so far, without waking them up.
+        '''
+        if self.settled_at == self.steps:
+            return
+        for agent, since in self.sleeping.items():
+            agent.skipSteps(self.steps - since)
+            self.sleeping[agent] = self.steps
+        self.settled_at = self.steps
 
     def get_breed_count(self, breed_class):
         '''
         Returns the current number of agents of certain breed in the queue.
         '''
-        return len(self.agents_by_breed[breed_class])
+        breed = self.breeds.get(breed_class)
+        return len(breed) if breed is not None else 0
@@ -0,0 +1,322 @@
+### space.py
+
+import math
+import random
+import numpy as np
+from collections import defaultdict
+from mesa.space import MultiGrid
+
+
+class PoleIndex:
+    """
+    Keeps track of where the charge poles are on the grid, so EVs can look up the poles within their
+    vision without going through every agent (mostly other EVs) in their neighbourhood.
+    For every vision the poles in sight of a cell are stored the first time that cell is asked for,
+    and forgotten again when a pole is added or removed.
+    """
+    def __init__(self, grid):
+        self.grid = grid
+        self.poles = defaultdict(list)      # position -> charge poles at that position
+        self.in_sight = {}                  # vision -> {position: positions of the poles in sight}
+        self.masks = {}                     # vision -> boolean grid of the cells with any pole in sight
+
+
+    def add(self, pole):
+        """
+        Registers a charge pole at its current position
+        """
+        self.poles[tuple(pole.pos)].append(pole)
+        self.in_sight.clear()
+        self.masks.clear()
+
+
+    def remove(self, pole):
+        """
+        Removes a charge pole from the index
+        """
+        pos = tuple(pole.pos)
+        self.poles[pos].remove(pole)
+        if not self.poles[pos]:
+            del self.poles[pos]
+        self.in_sight.clear()
+        self.masks.clear()
+
+
+    def polesAt(self, pos):
+        """
+        Returns the charge poles at a given position
+        """
+        return self.poles.get((pos[0], pos[1]), [])
+
+
+    def freeSockets(self, pos):
+        """
+        Returns the free sockets of the (first) pole at a given position, None if there is no pole
+        """
+        poles = self.polesAt(pos)
+        if poles:
+            return poles[0].free_poles
+
+
+    def polesInSight(self, pos, vision):
+        """
+        Returns the positions of all poles within vision of pos, once for every pole and in the same
+        order as MultiGrid.get_neighbors with a Moore neighbourhood including the center
+        """
+        cells = self.in_sight.get(vision)
+        if cells is None:
+            cells = self.in_sight[vision] = {}
+        pos = (pos[0], pos[1])
+        sight = cells.get(pos)
+        if sight is None:
+            sight = []
+            for coord in self.grid.iter_neighborhood(pos, moore=True, include_center=True, radius=vision):
+                for pole in self.poles.get(coord, ()):
+                    sight.append(pole.pos)
+            cells[pos] = sight
+        return sight
+
+
+    def sightMask(self, vision):
+        """
+        Returns a boolean (width, height) array which is True for the cells that have at least one pole
+        within vision, so a whole fleet of EVs can be checked at once
+        """
+        mask = self.masks.get(vision)
+        if mask is None:
+            mask = np.zeros((self.grid.width, self.grid.height), dtype=bool)
+            # the neighbourhood is symmetric, so the cells that see a pole are the neighbourhood of that pole
+            for pos in self.poles:
+                for coord in self.grid.iter_neighborhood(pos, moore=True, include_center=True, radius=vision):
+                    mask[coord] = True
+            self.masks[vision] = mask
+        return mask
+
+
+class EmptyCellGrid(MultiGrid):
+    """
+    MultiGrid that keeps its empty cells in an array with the position of every cell in it, instead of
+    Mesa's list of empties. Placing and removing agents updates the array in O(1) (a cell that is no longer
+    empty is replaced by the last empty cell), and find_empty picks a random empty cell in O(1), however
+    large or full the grid is.
+    Positions are turned into tuples, so agents whose pos became a list after moving are handled as well.
+    If a numpy Generator rng is given the empty cells are drawn from it, otherwise from the random module.
+    """
+    def __init__(self, width, height, torus, rng = None):
+        self.randrange = rng.integers if rng is not None else random.randrange
+        self.cells = np.arange(width * height, dtype=np.int64)      # the first n_empty are the empty cells, as x * height + y
+        self.slots = np.arange(width * height, dtype=np.int64)      # cell -> position in cells
+        self.n_empty = width * height
+        super().__init__(width, height, torus)
+
+
+    @property
+    def empties(self):
+        """
+        List of the empty cells, for code that expects the Mesa attribute
+        """
+        return [divmod(int(cell), self.height) for cell in self.cells[:self.n_empty]]
+
+
+    @empties.setter
+    def empties(self, positions):
+        # set by Grid.__init__ with all cells, the index above already covers that
+        pass
+
+
+    def _place_agent(self, pos, agent):
+        """ Place the agent at the correct location. """
+        x, y = pos
+        self.grid[x][y].add(agent)
+        self.fillCell(x * self.height + y)
+
+
+    def _remove_agent(self, pos, agent):
+        """ Remove the agent from the given location. """
+        x, y = pos
+        self.grid[x][y].remove(agent)
+        if not self.grid[x][y]:
+            self.emptyCell(x * self.height + y)
+
+
+    def fillCell(self, cell):
+        """
+        Takes a cell out of the empty cells, if it is in there
+        """
+        slot = self.slots[cell]
+        if slot < self.n_empty:
+            self.n_empty -= 1
+            last = self.cells[self.n_empty]
+            self.cells[slot] = last
+            self.slots[last] = slot
+            self.cells[self.n_empty] = cell
+            self.slots[cell] = self.n_empty
+
+
+    def emptyCell(self, cell):
+        """
+        Adds a cell to the empty cells, if it is not in there yet
+        """
+        slot = self.slots[cell]
+        if slot >= self.n_empty:
+            first = self.cells[self.n_empty]
+            self.cells[slot] = first
+            self.slots[first] = slot
+            self.cells[self.n_empty] = cell
+            self.slots[cell] = self.n_empty
+            self.n_empty += 1
+
+
+    def is_cell_empty(self, pos):
+        x, y = pos
+        return not self.grid[x][y]
+
+
+    def exists_empty_cells(self):
+        return self.n_empty > 0
+
+
+    def find_empty(self):
+        """ Pick a random empty cell. """
+        if self.n_empty == 0:
+            return None
+        return divmod(int(self.cells[self.randrange(self.n_empty)]), self.height)
+
+
+class GridGeometry:
+    """
+    Distances and directions on the grid, built once per model for an open (wrap = True) or closed grid.
+    Like the EV agents it treats both axes as wrapping around at the width of the grid (a square grid).
+    For the differences between two positions on the grid it keeps tables per axis of
+        the distance, with wrapping the shortest way around:  abs(d), or width - abs(d) if that is shorter
+        the direction of a step towards the target: -1, 0 or 1, the other way around if that is shorter
+    and the battery cost of every step an EV can take (one cell in any direction, or over the edge).
+    Positions off the grid (targets, see EV_Agent.newRandomPos) and positions that are not integers (the center
+    on a closed grid) fall back on the same formulas.
+    The vectorized variants do the same for arrays of positions.
+    """
+    def __init__(self, width, height, wrap):
+        self.width = width
+        self.height = height
+        self.wrap = wrap
+        self.offset = width - 1             # table index of a difference d is d + offset
+        differences = range(-self.offset, width)
+        self.distance_table = [self._distance(d) for d in differences]
+        self.direction_table = [self._direction(d) for d in differences]
+        steps = [-width + 1, -1, 0, 1, width - 1]
+        self.step_costs = {(dx, dy): self._stepCost(dx, dy) for dx in steps for dy in steps}
+
+
+    def _distance(self, d):
+        d = abs(d)
+        if self.wrap and d > 0.5 * self.width:
+            return self.width - d
+        return d
+
+
+    def _direction(self, d):
+        if d > 0:
+            return -1 if self.wrap and d > 0.5 * self.width else 1
+        if d < 0:
+            return 1 if self.wrap and d < -0.5 * self.width else -1
+        return 0
+
+
+    def _stepCost(self, dx, dy):
+        # the distance of a step over the edge is measured the other way around, whether the grid is open or not
+        dist = math.sqrt(dx * dx + dy * dy)
+        if dist > 0.5 * self.width:
+            dist = self.width - dist
+        return dist
+
+
+    def distance(self, d):
+        """
+        Distance along one axis for a difference d, wrapped if the grid is open
+        """
+        i = d + self.offset
+        if type(i) is int and 0 <= i < len(self.distance_table):
+            return self.distance_table[i]
+        return self._distance(d)
+
+
+    def direction(self, d):
+        """
+        Direction (-1, 0 or 1) along one axis to cover a difference d
+        """
+        i = d + self.offset
+        if type(i) is int and 0 <= i < len(self.direction_table):
+            return self.direction_table[i]
+        return self._direction(d)
+
+
+    def differences(self, pos, target):
+        """
+        Distance along both axes from pos to target
+        """
+        return [self.distance(target[0] - pos[0]), self.distance(target[1] - pos[1])]
+
+
+    def directions(self, pos, target):
+        """
+        Direction along both axes of a step from pos towards target
+        """
+        return [self.direction(target[0] - pos[0]), self.direction(target[1] - pos[1])]
+
+
+    def stepCost(self, pos, new_pos):
+        """
+        Length of the step from pos to new_pos, in tiles (km)
+        """
+        dx = new_pos[0] - pos[0]
+        dy = new_pos[1] - pos[1]
+        cost = self.step_costs.get((dx, dy))
+        if cost is None:
+            cost = self._stepCost(dx, dy)
+        return cost
+
+
+    def travelCost(self, pos, target):
+        """
+        Battery needed to get from pos to target with the most expensive steps, without wrapping
+        """
+        dx = abs(pos[0] - target[0])
+        dy = abs(pos[1] - target[1])
+        return (max(dx, dy) + 0.41421356237 * min(dx, dy)) * 0.3
+
+
+    def distanceMany(self, pos, target):
+        """
+        Distance along both axes from every row of pos to the same row of target, see differences
+        """
+        d = np.abs(target - pos)
+        if self.wrap:
+            d = np.where(d > 0.5 * self.width, self.width - d, d)
+        return d
+
+
+    def directionMany(self, pos, target):
+        """
+        Direction along both axes of a step from every row of pos to the same row of target, see directions
+        """
+        d = target - pos
+        direction = np.sign(d).astype(np.int64)
+        if self.wrap:
+            direction[np.abs(d) > 0.5 * self.width] *= -1
+        return direction
+
+
+    def stepCostMany(self, pos, new_pos):
+        """
+        Length of the steps from the rows of pos to the rows of new_pos, see stepCost
+        """
+        dist = np.sqrt(((new_pos - pos) ** 2).sum(axis=1))
+        return np.where(dist > 0.5 * self.width, self.width - dist, dist)
+
+
+    def travelCostMany(self, pos, targets):
+        """
+        Battery needed to get from pos to every row of targets, see travelCost
+        """
+        d = np.abs(np.asarray(targets) - pos)
+        return (d.max(axis=1) + 0.41421356237 * d.min(axis=1)) * 0.3
@@ -0,0 +1,234 @@
+### stats.py
+
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    Histogram of values in fixed bins between low and high, from which percentiles can be read in O(bins)
+    instead of sorting all values. Values outside the range are counted in the first or last bin.
+    The error of a percentile is at most one bin_width.
+    """
+    def __init__(self, low = -10, high = 100, bin_width = 0.1):
+        self.low = low
+        self.bin_width = bin_width
+        self.n_bins = int(round((high - low) / bin_width))
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.total = 0
+
+
+    def bin(self, value):
+        """
+        Returns the bin of a single value
+        """
+        b = int((value - self.low) / self.bin_width)
+        if b < 0:
+            return 0
+        if b >= self.n_bins:
+            return self.n_bins - 1
+        return b
+
+
+    def bins(self, values):
+        """
+        Returns the bins of an array of values
+        """
+        return np.clip(((np.asarray(values) - self.low) / self.bin_width).astype(np.int64), 0, self.n_bins - 1)
+
+
+    def add(self, value):
+        self.counts[self.bin(value)] += 1
+        self.total += 1
+
+
+    def remove(self, value):
+        self.counts[self.bin(value)] -= 1
+        self.total -= 1
+
+
+    def move(self, old, new):
+        """
+        Moves a value that changed from old to new
+        """
+        old_bin = self.bin(old)
+        new_bin = self.bin(new)
+        if old_bin != new_bin:
+            self.counts[old_bin] -= 1
+            self.counts[new_bin] += 1
+
+
+    def addMany(self, values):
+        np.add.at(self.counts, self.bins(values), 1)
+        self.total += len(values)
+
+
+    def removeMany(self, values):
+        np.add.at(self.counts, self.bins(values), -1)
+        self.total -= len(values)
+
+
+    def moveMany(self, old, new):
+        np.add.at(self.counts, self.bins(old), -1)
+        np.add.at(self.counts, self.bins(new), 1)
+
+
+    def percentile(self, q):
+        """
+        Returns the q-th percentile, interpolated the same way as np.percentile
+        """
+        if self.total == 0:
+            return np.nan
+        rank = q / 100 * (self.total - 1)
+        below = int(rank)
+        cumulative = np.cumsum(self.counts)
+        value = self.orderStatistic(cumulative, below)
+        if rank > below:
+            value += (rank - below) * (self.orderStatistic(cumulative, below + 1) - value)
+        return value
+
+
+    def orderStatistic(self, cumulative, k):
+        """
+        Returns the estimated k-th smallest value (from 0), assuming the values are spread evenly within a bin
+        """
+        b = int(np.searchsorted(cumulative, k, side='right'))
+        before = cumulative[b - 1] if b > 0 else 0
+        return self.low + self.bin_width * (b + (k - before + 0.5) / self.counts[b])
+
+
+
+class ModelStats:
+    """
+    Aggregates of the model that are updated by the agents whenever their state changes,
+    so the model reporters do not have to go through all agents on every collection.
+    Keeps the number of EVs, their total battery, age and time in state, the attempts to charge
+    and a QuantileSketch of the batteries, and the average usage of every charge pole.
+    The EVs that the skip-idle schedule lets sleep are only counted here: tick() adds a step to the
+    age (and time in state) totals of every sleeping EV, so the totals stay current without stepping them.
+    """
+    def __init__(self):
+        self.EVs = 0
+        self.battery_total = 0.0
+        self.battery_sketch = QuantileSketch()
+        self.age_total = 0
+        self.time_in_state_total = 0
+        self.attempts_success = 0
+        self.attempts_failed = 0
+        self.poles = []                     # charge pole of every slot in pole_usage
+        self.pole_usage = np.zeros(16)      # average usage of every charge pole
+        self.sleeping = 0                   # sleeping EVs, they get older every step
+        self.sleeping_in_state = 0          # sleeping EVs that also count their time in state (not charging)
+        self.falling_asleep = 0             # EVs put to sleep in this step, counted from the next step
+        self.falling_asleep_in_state = 0
+
+
+    def addEV(self, battery):
+        """
+        Registers a new EV (with age, time in state and attempts of 0)
+        """
+        self.EVs += 1
+        self.battery_total += battery
+        self.battery_sketch.add(battery)
+
+
+    def removeEV(self, battery, age, time_in_state, attempts_success, attempts_failed):
+        """
+        Takes an EV out of the aggregates
+        """
+        self.EVs -= 1
+        self.battery_total -= battery
+        self.battery_sketch.remove(battery)
+        self.age_total -= age
+        self.time_in_state_total -= time_in_state
+        self.attempts_success -= attempts_success
+        self.attempts_failed -= attempts_failed
+
+
+    def changeBattery(self, old, new):
+        self.battery_total += new - old
+        self.battery_sketch.move(old, new)
+
+
+    def addEVs(self, batteries):
+        """
+        Registers an array of new EVs
+        """
+        self.EVs += len(batteries)
+        self.battery_total += batteries.sum()
+        self.battery_sketch.addMany(batteries)
+
+
+    def removeEVs(self, batteries, ages, times_in_state, attempts_success, attempts_failed):
+        """
+        Takes an array of EVs out of the aggregates
+        """
+        self.EVs -= len(batteries)
+        self.battery_total -= batteries.sum()
+        self.battery_sketch.removeMany(batteries)
+        self.age_total -= ages.sum()
+        self.time_in_state_total -= times_in_state.sum()
+        self.attempts_success -= attempts_success.sum()
+        self.attempts_failed -= attempts_failed.sum()
+
+
+    def changeBatteries(self, old, new):
+        self.battery_total += (new - old).sum()
+        self.battery_sketch.moveMany(old, new)
+
+
+    def sleep(self, in_state):
+        """
+        Registers an EV that is put to sleep after its step, and whether it counts its time in state
+        """
+        self.falling_asleep += 1
+        self.falling_asleep_in_state += in_state
+
+
+    def wake(self, in_state):
+        """
+        Takes an EV that is woken up (before its step) out of the sleeping EVs
+        """
+        self.sleeping -= 1
+        self.sleeping_in_state -= in_state
+
+
+    def tick(self):
+        """
+        The end of a step: adds the step to the totals of the sleeping EVs
+        """
+        self.age_total += self.sleeping
+        self.time_in_state_total += self.sleeping_in_state
+        self.sleeping += self.falling_asleep
+        self.sleeping_in_state += self.falling_asleep_in_state
+        self.falling_asleep = 0
+        self.falling_asleep_in_state = 0
+
+
+    def addPole(self, pole):
+        """
+        Gives a charge pole a slot for its average usage
+        """
+        pole.stats_slot = len(self.poles)
+        self.poles.append(pole)
+        if len(self.poles) > len(self.pole_usage):
+            self.pole_usage = np.resize(self.pole_usage, 2 * len(self.pole_usage))
+        self.pole_usage[pole.stats_slot] = np.nan
+
+
+    def removePole(self, pole):
+        """
+        Removes a charge pole, its slot is taken over by the last pole
+        """
+        slot = pole.stats_slot
+        last = self.poles.pop()
+        if last is not pole:
+            self.poles[slot] = last
+            last.stats_slot = slot
+            self.pole_usage[slot] = self.pole_usage[len(self.poles)]
+
+
+    def usage(self):
+        """
+        Returns the average usage of all charge poles
+        """
+        return self.pole_usage[:len(self.poles)]
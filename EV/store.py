@@ -0,0 +1,123 @@
+### store.py
+
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def _plain(value):
+    # NumPy numbers (from np.arange or a sample) are stored as Python numbers
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot store %r" % (value,))
+
+
+def params_hash(params):
+    """
+    Returns a hash of the parameters of a run, that does not depend on their order or NumPy types
+    """
+    text = json.dumps(params, sort_keys=True, default=_plain)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def run_key(params, replicate):
+    """
+    Key of a run in the ResultStore: the hash of its parameters and its replicate
+    """
+    return "%s-%d" % (params_hash(params), replicate)
+
+
+class ResultStore:
+    """
+    Append-only store of the rows of finished runs, a file with one JSON row per line. Every row is written
+    and flushed to disk as soon as it is added, so a sweep that is interrupted only loses the runs that were
+    still going. When resuming, the runs that are already in the file are skipped; with resume = False the
+    file is started over.
+    The key of a run only covers its parameters, so the first line of the file holds the max_steps and the
+    names of the reporters of the sweep, and a store made with other ones is not resumed (ValueError).
+    """
+    def __init__(self, path, resume = True, max_steps = None, reporters = ()):
+        self.path = path
+        self.header = {"max_steps": max_steps, "reporters": sorted(reporters)}
+        self.results = {}           # key -> row
+        if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+            self.load()
+        else:
+            with open(path, "w") as f:
+                f.write(json.dumps({"Header": self.header}) + "\n")
+
+
+    def load(self):
+        """
+        Reads the rows in the file, a last line that was cut off by a crash is dropped
+        """
+        with open(self.path) as f:
+            lines = f.readlines()
+        header = None
+        for line in lines:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if "Header" in row:
+                header = row["Header"]
+            else:
+                self.results[row["Key"]] = row
+        if header != self.header:
+            raise ValueError("%s was made with %s, not with %s; start it over with resume = False"
+                             % (self.path, header or "unknown max_steps and reporters", self.header))
+        # rewrite the file if the last line was cut off, so new rows start on a line of their own
+        if not lines[-1].endswith("\n"):
+            with open(self.path, "w") as f:
+                f.write(json.dumps({"Header": self.header}) + "\n")
+                for row in self.results.values():
+                    f.write(json.dumps(row) + "\n")
+
+
+    def __len__(self):
+        return len(self.results)
+
+
+    def __contains__(self, key):
+        return key in self.results
+
+
+    def pending(self, tasks):
+        """
+        Returns the (run, replicate, parameters) tasks that are not in the store yet, each key only once
+        """
+        todo = []
+        keys = set(self.results)
+        for task in tasks:
+            key = run_key(task[2], task[1])
+            if key not in keys:
+                keys.add(key)
+                todo.append(task)
+        return todo
+
+
+    def add(self, row):
+        """
+        Appends the row of a finished run (with its "Key") to the file
+        """
+        line = json.dumps(row, default=_plain)
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.results[row["Key"]] = json.loads(line)
+
+
+    def rows(self, tasks = None):
+        """
+        Returns the stored rows, or the row of every task (in the order of the tasks) if tasks are given
+        """
+        if tasks is None:
+            return list(self.results.values())
+        rows = []
+        for run, replicate, params in tasks:
+            row = dict(self.results[run_key(params, replicate)])
+            row["Run"] = run
+            rows.append(row)
+        return rows
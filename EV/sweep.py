@@ -0,0 +1,155 @@
+### sweep.py
+
+import itertools
+import multiprocessing as mp
+import os
+import random
+from functools import partial
+import numpy as np
+from EV.store import run_key
+
+
+def replicate_seeds(seed, replicates):
+    """
+    Returns the seed of every replicate, spawned from seed (all None without a seed)
+    """
+    if seed is None:
+        return [None] * replicates
+    return [int(s) for s in np.random.SeedSequence(seed).generate_state(replicates)]
+
+
+def expand(fixed_params, variable_params, replicates = 1, seed = None):
+    """
+    Expands a parameter grid into one task per run: the cartesian product of the variable parameters
+    (in the same order as the Mesa BatchRunner), every combination repeated replicates times.
+    A task is (run, replicate, parameters).
+    If a seed is given, every replicate gets its own seed spawned from it, which is the same for all
+    combinations (common random numbers), so differences between combinations are not just noise.
+    """
+    names = list(variable_params)
+    seeds = replicate_seeds(seed, replicates)
+    tasks = []
+    combinations = itertools.product(*(variable_params[name] for name in names))
+    for i, values in enumerate(combinations):
+        params = dict(fixed_params)
+        params.update(zip(names, values))
+        for replicate in range(replicates):
+            if seeds[replicate] is None:
+                tasks.append((i, replicate, params))
+            else:
+                tasks.append((i, replicate, dict(params, seed=seeds[replicate])))
+    return tasks
+
+
+def run_until(model, max_steps):
+    """
+    Steps a model until max_steps, or until it stops running
+    """
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+
+
+def check_snapshots(model_cls, snapshot_path):
+    """
+    Raises a TypeError if a snapshot_path is given for a model class that cannot save its agent state
+    """
+    if snapshot_path is not None and not hasattr(model_cls, "saveAgentState"):
+        raise TypeError("snapshot_path needs a model with a saveAgentState method, %s has none" % model_cls.__name__)
+
+
+def run_model(model_cls, params, name, run, snapshot_path = None):
+    """
+    Makes a model with params, runs it with run(model) and finishes it (if it has a finish method, like EV_Model).
+    With a collect_path parameter, the time series of the model is written to the directory name in there,
+    and with a snapshot_path the state of the agents at the end is saved to <name>.npz in that directory.
+    Returns the model
+    """
+    check_snapshots(model_cls, snapshot_path)
+    if params.get("collect_path") is not None:
+        params = dict(params, collect_path=os.path.join(params["collect_path"], name))
+    model = model_cls(**params)
+    run(model)
+    finish = getattr(model, "finish", None)
+    if finish is not None:
+        finish()
+    if snapshot_path is not None:
+        os.makedirs(snapshot_path, exist_ok=True)
+        model.saveAgentState(os.path.join(snapshot_path, name + ".npz"))
+    return model
+
+
+def run_task(model_cls, task, max_steps, model_reporters, snapshot_path = None):
+    """
+    Runs a single model until max_steps (or until it stops running) and returns its row:
+    the parameters, run and replicate, its key in a ResultStore, the seed of the model, the number of steps
+    it ran and the values of the model reporters at the end of the run.
+    The time series and the snapshot of the run are named by its key (see run_model)
+    """
+    run, replicate, params = task
+    key = run_key(params, replicate)
+    model = run_model(model_cls, params, key, partial(run_until, max_steps=max_steps), snapshot_path)
+    row = dict(params)
+    row["Run"] = run
+    row["Replicate"] = replicate
+    row["Key"] = key
+    row["seed"] = getattr(model, "seed", None)
+    row["Steps"] = model.schedule.steps
+    for name, reporter in model_reporters.items():
+        row[name] = reporter(model)
+    return row
+
+
+def reseed_worker():
+    """
+    Pool initializer: forked workers start with the random state of the parent, every worker has to get its own
+    (only for models that use the global random state, EV_Model has its own seeded streams)
+    """
+    random.seed()
+    np.random.seed()
+
+
+class _Runner:
+    """
+    Picklable function object that runs a task in a worker
+    """
+    def __init__(self, model_cls, max_steps, model_reporters, snapshot_path = None):
+        self.model_cls = model_cls
+        self.max_steps = max_steps
+        self.model_reporters = model_reporters
+        self.snapshot_path = snapshot_path
+
+    def __call__(self, task):
+        return run_task(self.model_cls, task, self.max_steps, self.model_reporters, self.snapshot_path)
+
+
+def sweep(model_cls, fixed_params, variable_params, replicates = 1, max_steps = 1000, model_reporters = None,
+          processes = None, chunksize = None, tasks = None, snapshot_path = None):
+    """
+    Runs every combination of the variable parameters replicates times, each run exactly once, spread over a
+    pool of processes. Runs are handed out in chunks of chunksize tasks (by default small enough to give every
+    process about 4 chunks, so the cores keep busy until the last runs), and the rows are yielded as soon as
+    their run has finished, so not in the order of the tasks.
+    With processes = 1 the runs are done in this process, in order.
+    With a snapshot_path, the agent state at the end of every run is saved in there (see run_task).
+    A sweep can be resumed by adding every row to a ResultStore as soon as it comes in, and passing only the
+    tasks that are not in the store yet (store.pending(tasks)); the scripts start over with --restart.
+    With a convergence_window parameter (in steps) an EV_Model stops before max_steps once Usage, Percentage_failed
+    and Avg_Battery have settled (see EV/convergence.py), the step it stopped at is in the Steps column of its row.
+    """
+    if model_reporters is None:
+        model_reporters = {}
+    check_snapshots(model_cls, snapshot_path)
+    if tasks is None:
+        tasks = expand(fixed_params, variable_params, replicates)
+    runner = _Runner(model_cls, max_steps, model_reporters, snapshot_path)
+    if processes is None:
+        processes = mp.cpu_count()
+    if processes == 1:
+        for task in tasks:
+            yield runner(task)
+        return
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (4 * processes))
+    with mp.Pool(processes, initializer=reseed_worker) as pool:
+        for row in pool.imap_unordered(runner, tasks, chunksize):
+            yield row
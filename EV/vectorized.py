@@ -0,0 +1,641 @@
+### vectorized.py
+
+import numpy as np
+
+from EV.memory import PoleMemory, RecentSightings
+
+
+# codes used for the states and targets of the EVs in the fleet arrays
+STATES = ["traveling", "working", "shopping", "at_home", "charging", "searching"]
+TARGETS = ["", "work", "home", "shop", "charge_pole", "searching"]
+TRAVELING, WORKING, SHOPPING, AT_HOME, CHARGING, SEARCHING = range(len(STATES))
+NO_TARGET, WORK, HOME, SHOP, CHARGE_POLE, SEARCH = range(len(TARGETS))
+
+class EVFleet:
+    """
+    Struct-of-arrays engine for the EVs: the state of all EVs (positions, targets, directions, battery,
+    state and timers) is kept in NumPy arrays and all EVs are advanced together in one pass per timestep.
+    EV_Agent stays the reference implementation; the fleet follows the same rules, except that within
+    a timestep the EVs act phase by phase (targets, charging, pole sightings, moving) instead of one
+    agent after the other. EVs interact only through the free sockets of the poles, and where they do
+    (arriving at and leaving a pole) they are handled one at a time in a random order.
+    The rare decisions (choosing a pole, registering sighted poles) are made per EV with its PoleMemory.
+    EVs in the fleet are not placed on the MultiGrid, the grid only holds the charge poles.
+
+    The fleets of several models with the same parameters (the replicates of a ReplicateBatch) can be merged
+    into one, so the EVs of all replicates are stepped together. Every EV then has the replicate column of its
+    model, and the EVs of a replicate only meet the poles, statistics and random streams of their own model,
+    so every replicate runs exactly like its model would on its own.
+    """
+    # dtype and shape of every EV of the fleet arrays
+    COLUMNS = {"unique_id": (np.int64, ()), "alive": (bool, ()), "replicate": (np.int64, ()), "pos": (np.int64, (2,)),
+               "target_pos": (float, (2,)), "prev_target_pos": (float, (2,)), "direction": (np.int64, (2,)),
+               "home_pos": (np.int64, (2,)), "work_pos": (np.int64, (2,)), "center_pos": (float, (2,)),
+               "battery": (float, ()), "max_battery": (float, ()), "usual_charge_time": (float, ()),
+               "charge_speed": (float, ()), "time_charging": (np.int64, ()), "state": (np.int8, ()),
+               "target": (np.int8, ()), "prev_target": (np.int8, ()), "time_in_state": (np.int64, ()),
+               "how_long_at_work": (float, ()), "how_long_shopping": (float, ()), "how_long_at_home": (float, ()),
+               "minimum_battery_to_look_for_cp": (float, ()), "critical_battery_limit": (float, ()),
+               "age": (np.int64, ()), "initial_bravery": (float, ()), "attempts_success": (np.int64, ()),
+               "attempts_failed": (np.int64, ()), "current_strategy": (np.int8, ()), "looks": (np.int64, ())}
+
+    def __init__(self, model, capacity = 64):
+        self.model = model
+        self.models = [model]               # the model of every replicate, one unless fleets are merged
+        self.width = model.grid.width
+        self.height = model.grid.height
+        self.vision = model.vision
+        self.battery_size = model.battery_size
+        self.geometry = model.geometry      # wraps like EV_Agent.setDirection/chooseNextStep
+        # draws of the EVs of every replicate, the order of the events uses the schedule_rng of the model
+        self.rngs = [model.behaviour_rng]
+        # the same checks on model.open as used by EV_Agent (chooseCenterPos and newRandomPos respectively)
+        self.open_center = bool(model.open)
+        self.open_random = not model.open == False
+
+        self.size = 0                       # number of slots in use (alive or not)
+        self.count = 0                      # number of EVs alive
+        self.replicate_counts = [0]         # number of EVs alive of every replicate
+        self.free_slots = [[]]              # free slots of every replicate
+        self.paused = np.zeros(1, dtype=bool)   # replicates that are not stepped (their model stopped running)
+        self.memory = []                    # PoleMemory of every slot
+        self.offLimits = []                 # poles that are 'off limit' for every slot
+        self.sightings = []                 # RecentSightings of every slot
+        self._allocate(capacity)
+
+
+    @classmethod
+    def merge(cls, models):
+        """
+        Moves the EVs of the fleets of the models (with engine="vectorized" and the same parameters) into one
+        fleet, in which model i is replicate i. Every model gets a FleetReplicate of the merged fleet as its fleet
+        """
+        fleet = cls(models[0], sum(model.fleet.capacity for model in models))
+        fleet.models = list(models)
+        fleet.rngs = [model.behaviour_rng for model in models]
+        fleet.replicate_counts = [model.fleet.count for model in models]
+        fleet.free_slots = []
+        fleet.paused = np.zeros(len(models), dtype=bool)
+        for r, model in enumerate(models):
+            old = model.fleet
+            start = fleet.size
+            for name in cls.COLUMNS:
+                getattr(fleet, name)[start:start + old.size] = getattr(old, name)[:old.size]
+            fleet.replicate[start:start + old.size] = r
+            fleet.memory.extend(old.memory)
+            fleet.offLimits.extend(old.offLimits)
+            fleet.sightings.extend(old.sightings)
+            fleet.free_slots.append([start + i for i in old.free_slots[0]])
+            fleet.size += old.size
+            fleet.count += old.count
+        for r, model in enumerate(models):
+            model.fleet = FleetReplicate(fleet, r)
+        return fleet
+
+
+    def _allocate(self, capacity):
+        """
+        (Re)allocates all arrays to hold capacity EVs, keeping the current values
+        """
+        for name, (dtype, shape) in self.COLUMNS.items():
+            array = np.zeros((capacity,) + shape, dtype=dtype)
+            if self.size > 0:
+                array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+
+    def add(self, unique_ids, home_positions, work_positions, replicate = 0):
+        """
+        Adds new EVs with the given ids, homes and workplaces (to the given replicate).
+        Draws their properties the same way as EV_Agent.__init__
+        """
+        n = len(unique_ids)
+        if n == 0:
+            return
+        model = self.models[replicate]
+        rng = self.rngs[replicate]
+        reused = self.free_slots[replicate][:n]
+        del self.free_slots[replicate][:n]
+        new = n - len(reused)
+        if self.size + new > self.capacity:
+            self._allocate(max(2 * self.capacity, self.size + new))
+        idx = np.array(reused + list(range(self.size, self.size + new)), dtype=np.int64)
+        self.size += new
+        for i in idx:
+            if i < len(self.memory):
+                self.memory[i] = PoleMemory()
+                self.offLimits[i] = []
+                self.sightings[i] = RecentSightings()
+            else:
+                self.memory.append(PoleMemory())
+                self.offLimits.append([])
+                self.sightings.append(RecentSightings())
+
+        self.unique_id[idx] = unique_ids
+        self.alive[idx] = True
+        self.replicate[idx] = replicate
+        self.count += n
+        self.replicate_counts[replicate] += n
+
+        ## initial values for the battery and time components
+        max_battery = rng.integers(70, 80, n)
+        self.max_battery[idx] = max_battery
+        self.battery[idx] = rng.integers(50, max_battery)
+        self.usual_charge_time[idx] = rng.normal(25, 10, n)
+        self.charge_speed[idx] = 3
+        self.time_charging[idx] = 0
+        self.how_long_at_work[idx] = rng.normal(25, 3, n)
+        self.how_long_shopping[idx] = rng.normal(5, 3, n)
+        self.how_long_at_home[idx] = rng.normal(30, 5, n)
+        self.minimum_battery_to_look_for_cp[idx] = abs(rng.normal(30, 10, n))
+        self.critical_battery_limit[idx] = abs(rng.normal(5, 1, n))
+        self.age[idx] = 0
+        self.looks[idx] = 0                 # number of steps traveled, see RecentSightings
+
+        # only different if smaller battery size
+        if self.battery_size < 70:
+            max_battery = rng.integers(0.9 * self.battery_size, 1.1 * self.battery_size, n)
+            self.max_battery[idx] = max_battery
+            self.battery[idx] = rng.integers(0.75 * self.battery_size, max_battery)
+            self.minimum_battery_to_look_for_cp[idx] = abs(rng.normal(0.5 * self.battery_size, 0.1 * self.battery_size, n))
+        elif self.battery_size > 85:
+            print("the battery size is too high, for it to be a realistic input")
+
+        self.current_strategy[idx] = 0
+        self.prev_target[idx] = NO_TARGET
+        self.prev_target_pos[idx] = np.nan
+        self.attempts_success[idx] = 0
+        self.attempts_failed[idx] = 0
+        self.initial_bravery[idx] = abs(np.round(rng.normal(model.initial_bravery, 5, n)))
+
+        ## initial values for the state and target of the EV
+        self.time_in_state[idx] = 0
+        self.home_pos[idx] = home_positions
+        self.pos[idx] = home_positions
+        self.work_pos[idx] = work_positions
+        self.chooseCenterPos(idx)
+        self.target[idx] = rng.choice([WORK, HOME, SHOP], n)
+        home = idx[self.target[idx] == HOME]
+        work = idx[self.target[idx] == WORK]
+        self.target_pos[home] = self.home_pos[home]
+        self.target_pos[work] = self.work_pos[work]
+        self.newRandomPos(idx[self.target[idx] == SHOP])
+        self.state[idx] = TRAVELING
+        self.setDirection(idx)
+        model.stats.addEVs(self.battery[idx])
+
+
+    def remove(self, idx):
+        """
+        Removes the EVs in the given slots
+        """
+        for r, sel in self.groups(idx):
+            removed = idx[sel]
+            self.models[r].stats.removeEVs(self.battery[removed], self.age[removed], self.time_in_state[removed],
+                                           self.attempts_success[removed], self.attempts_failed[removed])
+            self.replicate_counts[r] -= len(removed)
+            self.free_slots[r].extend(int(i) for i in removed)
+        self.alive[idx] = False
+        self.count -= len(idx)
+        for i in idx:
+            self.memory[i] = None
+            self.offLimits[i] = None
+            self.sightings[i] = None
+
+
+    def values(self, name, replicate = None):
+        """
+        Returns the values of an attribute (for example "battery" or "age") for all EVs alive (of a replicate)
+        """
+        alive = self.alive[:self.size]
+        if replicate is not None:
+            alive = alive & (self.replicate[:self.size] == replicate)
+        return getattr(self, name)[:self.size][alive]
+
+
+    def groups(self, idx):
+        """
+        Splits the EVs in idx by replicate: yields every replicate with EVs in idx, and the positions in idx
+        of its EVs (in the same order). With a single replicate that is all of idx
+        """
+        if len(self.models) == 1:
+            yield 0, slice(None)
+            return
+        replicates = self.replicate[idx]
+        order = np.argsort(replicates, kind="stable")
+        bounds = np.searchsorted(replicates[order], np.arange(len(self.models) + 1))
+        for r in range(len(self.models)):
+            if bounds[r] < bounds[r + 1]:
+                yield r, order[bounds[r]:bounds[r + 1]]
+
+
+    def draw(self, idx, function):
+        """
+        Returns random values for the EVs in idx, each drawn from the stream of its own replicate:
+        function(rng, sel) has to return the values for the EVs idx[sel]
+        """
+        if len(self.models) == 1:
+            return function(self.rngs[0], slice(None))
+        values = None
+        for r, sel in self.groups(idx):
+            drawn = np.asarray(function(self.rngs[r], sel))
+            if values is None:
+                values = np.empty((len(idx),) + drawn.shape[1:], dtype=drawn.dtype)
+            values[sel] = drawn
+        if values is None:
+            values = function(self.rngs[0], slice(0, 0))
+        return values
+
+
+    def perReplicate(self, idx, values = None):
+        """
+        Returns the number of EVs in idx of every replicate, or the sum of their values
+        """
+        if len(self.models) == 1:
+            return [len(idx) if values is None else values.sum()]
+        totals = np.bincount(self.replicate[idx], values, minlength=len(self.models))
+        return totals if values is None else totals.astype(values.dtype)
+
+
+    def changeBatteries(self, idx, old_battery):
+        """
+        Registers the change of the batteries of the EVs in idx in the statistics of their models
+        """
+        for r, sel in self.groups(idx):
+            self.models[r].stats.changeBatteries(old_battery[sel], self.battery[idx[sel]])
+
+
+    def step(self):
+        """
+        Advances all EVs by one timestep, the same as EV_Agent.step for every EV
+        (only the EVs of the replicates that are not paused)
+        """
+        live = np.flatnonzero(self.alive[:self.size])
+        if self.paused.any():
+            live = live[~self.paused[self.replicate[live]]]
+        dead = live[self.battery[live] <= 0]
+        if len(dead) > 0:
+            for model, n in zip(self.models, self.perReplicate(dead)):
+                model.current_EVs -= n
+            self.remove(dead)
+        active = live[self.battery[live] > 0]
+
+        self.age[active] += 1
+        for model, n in zip(self.models, self.perReplicate(active)):
+            model.stats.age_total += n
+        profiler = self.model.profiler
+        if profiler is None:
+            self.checkTargets(active)
+            traveling = active[self.state[active] == TRAVELING]
+            self.getNeighbourhood(traveling)
+            new_positions = self.chooseNextStep(traveling)
+            self.moveEV(traveling, new_positions)
+            return
+        # the same phases, timed (the calls count the EVs that went through a phase, like for EV_Agent)
+        start = profiler.clock()
+        self.checkTargets(active)
+        end = profiler.clock()
+        profiler.add("checkTargets", end - start, len(active))
+        traveling = active[self.state[active] == TRAVELING]
+        start = end
+        self.getNeighbourhood(traveling)
+        end = profiler.clock()
+        profiler.add("getNeighbourhood", end - start, len(traveling))
+        start = end
+        new_positions = self.chooseNextStep(traveling)
+        end = profiler.clock()
+        profiler.add("chooseNextStep", end - start, len(traveling))
+        self.moveEV(traveling, new_positions)
+        profiler.add("moveEV", profiler.clock() - end, len(traveling))
+
+
+    def checkTargets(self, idx):
+        """
+        Checks whether EVs need to look for a charger and whether targets are reached, see EV_Agent.checkTargets
+        """
+        target = self.target[idx]
+        looking = idx[(self.battery[idx] < self.minimum_battery_to_look_for_cp[idx]) & (target != CHARGE_POLE) & (target != SEARCH)]
+        for i in looking:
+            self.chooseTargetPole(i)
+
+        at_target = (self.target_pos[idx] == self.pos[idx]).all(axis=1)
+        self.state[idx[~at_target]] = TRAVELING
+        arrived = idx[at_target]
+        target = self.target[arrived]
+
+        leaving = self.stay(arrived[target == WORK], WORKING, self.how_long_at_work)
+        self.target[leaving] = SHOP
+        self.how_long_shopping[leaving] = self.draw(leaving, lambda rng, sel: rng.normal(5, 3, len(leaving[sel])))
+        self.newRandomPos(leaving)
+
+        leaving = self.stay(arrived[target == SHOP], SHOPPING, self.how_long_shopping)
+        self.target[leaving] = HOME
+        self.how_long_at_home[leaving] = self.draw(leaving, lambda rng, sel: rng.normal(30, 5, len(leaving[sel])))
+        self.target_pos[leaving] = self.home_pos[leaving]
+        self.setDirection(leaving)
+
+        leaving = self.stay(arrived[(target == HOME) | (target == NO_TARGET)], AT_HOME, self.how_long_at_home)
+        self.target[leaving] = WORK
+        self.how_long_at_work[leaving] = self.draw(leaving, lambda rng, sel: rng.normal(25, 3, len(leaving[sel])))
+        self.target_pos[leaving] = self.work_pos[leaving]
+        self.setDirection(leaving)
+
+        searching = arrived[target == SEARCH]
+        self.state[searching] = SEARCHING
+        for i in searching:
+            self.chooseTargetPole(i)
+
+        at_pole = arrived[target == CHARGE_POLE]
+        self.state[at_pole] = CHARGING
+        arriving = at_pole[self.time_charging[at_pole] == 0]
+        releasing = self.charge(at_pole[self.time_charging[at_pole] > 0])
+        # taking and freeing sockets is where the EVs interact, so this is done one EV at a time in random order
+        # (every replicate on its own, with the schedule_rng of its model)
+        events = np.concatenate((arriving, releasing))
+        is_arriving = np.arange(len(events)) < len(arriving)
+        for r, sel in self.groups(events):
+            replicate_events = events[sel]
+            replicate_arriving = is_arriving[sel]
+            for k in self.models[r].schedule_rng.permutation(len(replicate_events)):
+                if replicate_arriving[k]:
+                    self.arriveAtPole(replicate_events[k])
+                else:
+                    self.freePlace(replicate_events[k])
+
+
+    def stay(self, idx, state, how_long):
+        """
+        EVs at their destination get the given state and stay there for how_long timesteps.
+        Returns the EVs that are done and leave
+        """
+        in_state = self.state[idx] == state
+        staying = idx[in_state]
+        self.state[idx[~in_state]] = state
+        done = self.time_in_state[staying] >= how_long[staying]
+        self.time_in_state[staying[~done]] += 1
+        leaving = staying[done]
+        for model, n_staying, n_leaving, time_left in zip(self.models, self.perReplicate(staying), self.perReplicate(leaving),
+                                                          self.perReplicate(leaving, self.time_in_state[leaving])):
+            model.stats.time_in_state_total += n_staying - n_leaving - time_left
+        self.time_in_state[leaving] = 0
+        return leaving
+
+
+    def charge(self, idx):
+        """
+        Charges the EVs in idx and checks if conditions for charging complete are met, see EV_Agent.charge.
+        Returns the EVs that are done charging, their socket still has to be freed
+        """
+        self.time_charging[idx] += 1
+        charging = (self.time_charging[idx] < self.usual_charge_time[idx]) | (self.battery[idx] < self.max_battery[idx])
+        still = idx[charging]
+        old_battery = self.battery[still]
+        self.battery[still] = np.minimum(old_battery + self.charge_speed[still], np.maximum(old_battery, self.max_battery[still]))
+        self.changeBatteries(still, old_battery)
+        done = idx[~charging]
+        self.target[done] = self.prev_target[done]
+        self.target_pos[done] = self.prev_target_pos[done]
+        self.state[done] = TRAVELING
+        self.setDirection(done)
+        self.time_charging[done] = 0
+        self.current_strategy[done] = 0
+        for i in done:
+            self.offLimits[i] = []
+        return done
+
+
+    def arriveAtPole(self, i):
+        """
+        An EV arrives at its target pole and takes a socket if there is one free, otherwise it looks for another pole
+        """
+        model = self.models[self.replicate[i]]
+        pos = (int(self.pos[i, 0]), int(self.pos[i, 1]))
+        if model.pole_index.freeSockets(pos) > 0:
+            for pole in model.pole_index.polesAt(pos):
+                pole.free_poles -= 1
+            for j in self.charge(np.array([i])):
+                self.freePlace(j)
+            self.attempts_success[i] += 1
+            model.stats.attempts_success += 1
+        else:
+            self.offLimits[i] = pos
+            self.chooseTargetPole(i)
+            self.attempts_failed[i] += 1
+            model.stats.attempts_failed += 1
+
+
+    def freePlace(self, i):
+        """
+        Registers that charging is complete and a space at the pole is freed up
+        """
+        for pole in self.models[self.replicate[i]].pole_index.polesAt(self.pos[i]):
+            pole.free_poles += 1
+
+
+    def getNeighbourhood(self, idx):
+        """
+        Registers the charge poles within vision of the EVs in idx, see EV_Agent.getNeighbourhood.
+        Only EVs with at least one pole in sight need to be looked at one by one.
+        """
+        self.looks[idx] += 1
+        if len(self.models) == 1:
+            mask = self.model.pole_index.sightMask(self.vision)
+            seeing = idx[mask[self.pos[idx, 0], self.pos[idx, 1]]]
+        else:
+            masks = np.stack([model.pole_index.sightMask(self.vision) for model in self.models])
+            seeing = idx[masks[self.replicate[idx], self.pos[idx, 0], self.pos[idx, 1]]]
+        for i in seeing:
+            self.registerPoles(i)
+
+
+    def registerPoles(self, i):
+        """
+        Updates the memory of a single EV with the poles in sight, and sets a pole as target if
+        the battery is (very) low. Poles that were newly seen during the last 3 steps are skipped.
+        """
+        done = False
+        sightings = self.sightings[i]
+        sightings.look(self.looks[i])
+        neighbors = []
+        model = self.models[self.replicate[i]]
+        points = model.pole_index.polesInSight(self.pos[i], self.vision)
+        if model.profiler is not None:
+            model.profiler.count("pole_sightings", len(points))
+        for point in points:
+            if point in sightings:
+                continue
+            neighbors.append(point)
+            if model.pole_index.freeSockets(point) > 0:
+                self.updateMemory(i, 1, point)
+                battery = self.battery[i]
+                target = self.target[i]
+                if (battery < self.critical_battery_limit[i] and done == False) or (battery < self.minimum_battery_to_look_for_cp[i] and target != CHARGE_POLE):
+                    if target != CHARGE_POLE and target != SEARCH:
+                        self.prev_target[i] = target
+                        self.prev_target_pos[i] = self.target_pos[i]
+                    self.target_pos[i] = point
+                    self.setDirection([i])
+                    self.target[i] = CHARGE_POLE
+                    done = True
+            else:
+                self.updateMemory(i, -1, point)
+                if self.battery[i] < 100:
+                    self.offLimits[i] = [point]
+        sightings.add(neighbors)
+
+
+    def updateMemory(self, i, succes, pos):
+        """
+        Saves a new memory for a single EV, which also counts for its current strategy if the pole is the target
+        """
+        profiler = self.models[self.replicate[i]].profiler
+        if profiler is not None:
+            profiler.count("memory_updates")
+        strategy = 0
+        if self.current_strategy[i] > 0 and pos[0] == self.target_pos[i, 0] and pos[1] == self.target_pos[i, 1]:
+            strategy = self.current_strategy[i]
+        self.memory[i].update(succes, pos, strategy)
+
+
+    def chooseTargetPole(self, i):
+        """
+        If possible, chooses target pole for a single EV. Otherwise starts exploring to a completely
+        random position, see EV_Agent.chooseTargetPole
+        """
+        model = self.models[self.replicate[i]]
+        rng = self.rngs[self.replicate[i]]
+        if model.profiler is not None:
+            model.profiler.count("target_selections")
+        if self.target[i] != SEARCH and self.target[i] != CHARGE_POLE:
+            self.prev_target[i] = self.target[i]
+            self.prev_target_pos[i] = self.target_pos[i]
+        self.current_strategy[i] = self.memory[i].chooseStrategy(rng.random())
+
+        options = self.checkOptions(i)
+
+        if len(options) == 0:
+            self.target[i] = SEARCH
+            self.target_pos[i] = (rng.integers(0, self.width), rng.integers(0, self.height))
+        else:
+            self.target_pos[i] = self.memory[i].bestOption(options, self.pos[i], self.battery[i], self.current_strategy[i])
+            self.target[i] = CHARGE_POLE
+        self.setDirection([i])
+
+
+    def checkOptions(self, i):
+        """
+        Returns the rows in memory of the known poles of a single EV that are options as targets, see EV_Agent.checkOptions
+        """
+        memory = self.memory[i]
+        battery_required = self.geometry.travelCostMany(self.pos[i], memory.coordinates())
+        return memory.optionRows(battery_required <= self.battery[i], self.offLimits[i])
+
+
+    def chooseCenterPos(self, idx):
+        """
+        Chooses the center position between home and work, depending on if it is a closed or open grid
+        """
+        home = self.home_pos[idx]
+        work = self.work_pos[idx]
+        if self.open_center:
+            center = np.trunc((home + work) / 2)
+            far = abs(home - work) > 0.5 * self.width
+            center = np.where(far & (home < work), home - np.trunc((home + (100 - work)) / 2), center)
+            center = np.where(far & (home >= work), work - np.trunc((work + (100 - home)) / 2), center)
+            center = np.where(center < 0, center + self.width, center)
+            center = np.where(center >= self.width, center - self.width, center)
+        else:
+            center = (home + work) / 2
+        self.center_pos[idx] = center
+
+
+    def newRandomPos(self, idx):
+        """
+        Chooses new random positions around center_pos, depending on the initial bravery and poles in memory,
+        see EV_Agent.newRandomPos
+        """
+        if len(idx) == 0:
+            return
+        polesInMemory = np.array([len(self.memory[i]) for i in idx])
+        scale = self.initial_bravery[idx] / np.maximum(polesInMemory, 1)
+        bravery = np.round(self.draw(idx, lambda rng, sel: rng.exponential(scale[sel])))
+        bravery = bravery[:, None]
+        center = self.center_pos[idx]
+        if not self.open_random:
+            low = np.maximum(center - bravery, 0)
+            high = np.minimum(center + bravery, [self.width - 1, self.height - 1])
+            newPos = np.where(self.draw(idx, lambda rng, sel: rng.random((len(idx[sel]), 2))) < 0.5, low, high)
+        else:
+            high = 2 * bravery.astype(np.int64) + 1
+            newPos = center - bravery + self.draw(idx, lambda rng, sel: rng.integers(0, high[sel], (len(idx[sel]), 2)))
+            newPos = np.where(newPos < 0, newPos + self.width, newPos)
+            newPos = np.where(newPos >= self.width, newPos - self.width, newPos)
+        self.target_pos[idx] = newPos
+        self.setDirection(idx)
+
+
+    def setDirection(self, idx):
+        """
+        Sets the direction of the EVs in idx towards their target
+        """
+        self.direction[idx] = self.geometry.directionMany(self.pos[idx], self.target_pos[idx])
+
+
+    def chooseNextStep(self, idx):
+        """
+        Makes sure that one step is taken towards the target, also on a toroidal grid, see EV_Agent.chooseNextStep.
+        Returns the new positions
+        """
+        pos = self.pos[idx]
+        difference = self.geometry.distanceMany(pos, self.target_pos[idx])
+        d0 = difference[:, 0]
+        d1 = difference[:, 1]
+        r = self.draw(idx, lambda rng, sel: rng.random(len(idx[sel])))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step0 = (d0 >= d1) | ((d0 != 0) & (r < d0 / d1))
+            step1 = (d0 <= d1) | ((d1 != 0) & (r < d1 / d0))
+        new_position = pos + self.direction[idx] * np.stack((step0, step1), axis=1)
+        new_position[new_position == -1] = self.width - 1
+        new_position[new_position == self.width] = 0
+        return new_position
+
+
+    def moveEV(self, idx, new_positions):
+        """
+        Changes the positions and drains the batteries, considering one tile is 1 km
+        """
+        dist = self.geometry.stepCostMany(self.pos[idx], new_positions)
+        # average battery cost per km is between 0.08 and 0.3 kwh
+        old_battery = self.battery[idx]
+        self.battery[idx] = old_battery - dist * ((0.30 - 0.08) * self.draw(idx, lambda rng, sel: rng.random(len(idx[sel]))) + 0.08)
+        self.changeBatteries(idx, old_battery)
+        self.pos[idx] = new_positions
+
+
+
+class FleetReplicate:
+    """
+    One replicate of a merged EVFleet, used as the fleet of its model: the reporters of the model only see
+    the EVs of this replicate. The replicates are stepped together, by ReplicateBatch.step
+    """
+    def __init__(self, fleet, replicate):
+        self.fleet = fleet
+        self.replicate = replicate
+
+
+    @property
+    def count(self):
+        return self.fleet.replicate_counts[self.replicate]
+
+
+    def values(self, name):
+        return self.fleet.values(name, self.replicate)
+
+
+    def add(self, unique_ids, home_positions, work_positions):
+        self.fleet.add(unique_ids, home_positions, work_positions, self.replicate)
+
+
+    def step(self):
+        raise RuntimeError("the EVs of a replicate are stepped together with the other replicates, by ReplicateBatch.step")
@@ -1,55 +1,58 @@
 
 #run.py
-from mesa.batchrunner import BatchRunner
 from EV.model import *
+from EV.sweep import expand, sweep
+from EV.store import ResultStore
 import multiprocessing as mp
 import pandas as pd
+import sys
 
 
 
 
 cores = mp.cpu_count()
-
-results = []
-
-
-def run_model():
-    fixed_params = {"width": 80,
-                    "height": 80,
-                    "initial_bravery": 10,
-                    "battery_size": 75}
-    variable_params = {"N": np.arange(100,500,150),                   # 3
-                       "n_poles": [1/10,1/8,1/6,1/4],                 # 4
-                       "vision": [1,2],                      # 3
-                       "grid_positions": ["LHS", "circle"],           # 2
-                       "open_grid": ["True", "False"]}                # 2
-                                                                      # 3*4*3*2*2 = 144
-    batch_run = BatchRunner(EV_Model,
-                            fixed_parameters=fixed_params,
-                            variable_parameters=variable_params,
-                            iterations=1,
-                            max_steps=2500,
-                            model_reporters={"Usage": avg_usage,
-                                             "Total_attempts": totalAttempts,
-                                             "Percentage_failed": percentageFailed,
-                                             "Average_lifespan": averageLifespan})
-    batch_run.run_all()
-
-    run_data = batch_run.get_model_vars_dataframe()
-
-    return run_data.values.tolist()
+replicates = 8
+seed = 20180202             # every replicate gets a seed spawned from this one, shared by all combinations
+max_steps = 2500
+
+fixed_params = {"width": 80,
+                "height": 80,
+                "initial_bravery": 10,
+                "battery_size": 75,
+                "collect_every": 0}                                # only the end of the run is used
+convergence_window = 0      # stop a run once its reporters settled (see EV.sweep.sweep), 0 always runs max_steps
+if convergence_window:
+    fixed_params.update({"convergence_window": convergence_window, "convergence_tolerance": 0.01})
+variable_params = {"N": np.arange(100,500,150),                   # 3
+                   "n_poles": [1/10,1/8,1/6,1/4],                 # 4
+                   "vision": [1,2],                      # 3
+                   "grid_positions": ["LHS", "circle"],           # 2
+                   "open_grid": ["True", "False"]}                # 2
+                                                                  # 3*4*3*2*2 = 144
+model_reporters = {"Usage": avg_usage,
+                   "Total_attempts": totalAttempts,
+                   "Percentage_failed": percentageFailed,
+                   "Average_lifespan": averageLifespan}
+
+# column name of every parameter and reporter in the csv
+columns = {"N": "N", "n_poles": "N_poles", "vision": "Vision", "grid_positions": "Grid_positions", "open_grid": "Grid_open",
+           "Run": "run", "Replicate": "Replicate", "seed": "Seed", "Average_lifespan": "Average_lifespan", "Percentage_failed": "Percentage_failed",
+           "Total_attempts": "Total_attempts", "Usage": "Usage", "width": "Width", "height": "Height",
+           "initial_bravery": "Initial_bravery", "battery_size": "Battery_size", "collect_every": "Collect_every", "Steps": "Steps"}
 
 
 if __name__ == "__main__":
-    results = []
-    pool = mp.Pool(cores)
-    for i in range(8):
-        def callback(result):
-            results.extend(result)
-        pool.apply_async(run_model, callback=callback)
-    pool.close()
-    pool.join()
-    df = pd.DataFrame(results, columns=["N","N_poles","Vision","Grid_positions","Grid_open","run","Average_lifespan","Percentage_failed","Total_attempts","Usage","Width","Height","Initial_bravery","Battery_size"])
+    # every combination is run replicates times, each run is a separate task for the pool
+    tasks = expand(fixed_params, variable_params, replicates, seed)
+    # runs that are in the store already are skipped (see EV.sweep.sweep)
+    store = ResultStore("180202_1.jsonl", resume="--restart" not in sys.argv, max_steps=max_steps, reporters=model_reporters)
+    todo = store.pending(tasks)
+    for i, row in enumerate(sweep(EV_Model, fixed_params, variable_params, max_steps=max_steps, model_reporters=model_reporters,
+                                  processes=cores, tasks=todo)):
+        store.add(row)
+        print("%d/%d runs done" % (len(tasks) - len(todo) + i + 1, len(tasks)), end="\r")
+    # (rows stored before the Steps were recorded have no Steps)
+    df = pd.DataFrame(store.rows(tasks)).reindex(columns=list(columns)).rename(columns=columns)
     print(df)
 
     df.to_csv("180202_1.csv",sep=",",header=True)
@@ -1,71 +1,94 @@
 
 #run.py
-from Batch import batchRunner
 from EV.model import *
+from EV.sweep import sweep
+from EV.store import ResultStore
+from SALib.sample import saltelli
+from SALib.analyze import sobol
 import multiprocessing as mp
 import pandas as pd
-from time import time
-import os
+import sys
 
 
 cores = mp.cpu_count()
-iterations = 100
+samples = 64                # base samples of the Saltelli design, gives samples * (2D + 2) runs
+second_order = True
+seed = 20180202             # all samples use the same seed (common random numbers), so the indices are not blurred by noise
+max_steps = 2500
 
-def run_model():
-    output = []
-    fixed_params = {"N": [],
-                    "n_poles": [],
-                    "vision": [],
-                    "grid_positions": [],
-                    "open_grid": [],
-                    "width": 80,
-                    "height": 80,
-                    "initial_bravery": 10,
-                    "battery_size": 75}
+fixed_params = {"width": 80,
+                "height": 80,
+                "initial_bravery": 10,
+                "battery_size": 75,
+                "collect_every": 0}                                # only the end of the run is used
+convergence_window = 0      # stop a run once its reporters settled (see EV.sweep.sweep), 0 always runs max_steps
+if convergence_window:
+    fixed_params.update({"convergence_window": convergence_window, "convergence_tolerance": 0.01})
 
+# the discrete parameters are sampled as a uniform number in [0, number of choices) and rounded down
+problem = {"num_vars": 5,
+           "names": ["N", "n_poles", "vision", "grid_positions", "open_grid"],
+           "bounds": [[100, 400], [0.1, 0.25], [0, 2], [0, 2], [0, 2]]}
+choices = {"vision": [1, 2],
+           "grid_positions": ["LHS", "circle"],
+           "open_grid": ["True", "False"]}
 
-    RandomParams = {"N": np.random.uniform(100,400,iterations),
-                    "n_poles": np.random.uniform(0.1,0.25,iterations),
-                    "vision": np.random.choice([1,2],iterations),
-                    "grid_positions": np.random.choice(["LHS","circle"],iterations),
-                    "open_grid": np.random.choice(["True","False"],iterations)}
+model_reporters = {"Usage": avg_usage,
+                   "Total_attempts": totalAttempts,
+                   "Percentage_failed": percentageFailed,
+                   "Average_lifespan": averageLifespan}
 
-    for i in range(iterations):
-        keys = []
-        for key in RandomParams:
-            if key == "N":
-                fixed_params[key] = int(RandomParams[key][i])
-            else:
-                fixed_params[key] = RandomParams[key][i]
-            keys.append(fixed_params[key])
 
-        batch_run = batchRunner(EV_Model,
-                                fixed_parameters=fixed_params,
-                                variable_parameters={},
-                                iterations=1,
-                                max_steps=2500,
-                                model_reporters={"Usage": avg_usage,
-                                                 "Total_attempts": totalAttempts,
-                                                 "Percentage_failed": percentageFailed,
-                                                 "Average_lifespan": averageLifespan})
+def sample_params(x):
+    """
+    Turns a row of the Saltelli design into the parameters of a model
+    """
+    params = dict(fixed_params)
+    for name, value in zip(problem["names"], x):
+        if name in choices:
+            params[name] = choices[name][min(int(value), len(choices[name]) - 1)]
+        elif name == "N":
+            params[name] = int(value)
+        else:
+            params[name] = value
+    return params
 
-        batch_run.run_all()
-        run_data = batch_run.get_model_vars_dataframe().values.tolist()
-        run_data[0].extend(keys)
-        output.extend(run_data)
-    return output
+
+def analyze(df):
+    """
+    Computes the first order, total and (if second_order) second order Sobol indices of every reporter,
+    the rows of df have to be in the order of the design
+    """
+    indices = []
+    for output in model_reporters:
+        Y = df[output].values.astype(float)
+        if np.isnan(Y).any():
+            print("Skipping %s, %d runs have no value" % (output, np.isnan(Y).sum()))
+            continue
+        Si = sobol.analyze(problem, Y, calc_second_order=second_order, print_to_console=False)
+        for i, name in enumerate(problem["names"]):
+            indices.append([output, name, Si["S1"][i], Si["S1_conf"][i], Si["ST"][i], Si["ST_conf"][i]])
+    return pd.DataFrame(indices, columns=["Output","Parameter","S1","S1_conf","ST","ST_conf"])
 
 
 if __name__ == "__main__":
-    results = []
-    pool = mp.Pool(cores)
-    for i in range(7):
-        def callback(result):
-            results.extend(result)
-        pool.apply_async(run_model, callback=callback)
-    pool.close()
-    pool.join()
-    df = pd.DataFrame(results, columns=["run","Average_lifespan","Percentage_failed","Total_attempts","Usage","N","N_poles","Vision","Grid_positions","Grid_open"])
+    # one Saltelli design for all processes, every sample is run once
+    design = saltelli.sample(problem, samples, calc_second_order=second_order)
+    tasks = [(i, 0, dict(sample_params(x), seed=seed)) for i, x in enumerate(design)]
+    # runs that are in the store already are skipped (see EV.sweep.sweep); samples with the same parameters share one run
+    store = ResultStore("SOBOL1.jsonl", resume="--restart" not in sys.argv, max_steps=max_steps, reporters=model_reporters)
+    todo = store.pending(tasks)
+    for i, row in enumerate(sweep(EV_Model, fixed_params, {}, max_steps=max_steps, model_reporters=model_reporters,
+                                  processes=cores, tasks=todo)):
+        store.add(row)
+        print("%d/%d runs done" % (len(tasks) - len(todo) + i + 1, len(tasks)), end="\r")
+    df = pd.DataFrame(store.rows(tasks))
+    df = df.reindex(columns=["Run","Average_lifespan","Percentage_failed","Total_attempts","Usage","N","n_poles","vision","grid_positions","open_grid","seed","Steps"])
+    df.columns = ["run","Average_lifespan","Percentage_failed","Total_attempts","Usage","N","N_poles","Vision","Grid_positions","Grid_open","Seed","Steps"]
     print(df)
 
-    df.to_csv("SOBOL1.csv",sep=",",header=True)
\ No newline at end of file
+    df.to_csv("SOBOL1.csv",sep=",",header=True)
+
+    indices = analyze(df)
+    print(indices)
+    indices.to_csv("SOBOL1_indices.csv",sep=",",header=True)
@@ -0,0 +1,148 @@
+
+#benchmark.py
+# Times EV_Model over a grid of settings: construction, steps (split into the phases of EV_Model.step) and the
+# data collection, and writes the results to a JSON file so runs of different commits can be compared.
+#   python benchmark.py --N 100 1000 --size 40 100 --steps 200 --output results.json
+#   python benchmark.py ... --compare old_results.json
+#   python benchmark.py --N 2000 --size 100 --grid-positions random --open-grid True --skip-idle False True --warmup 200
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import warnings
+from EV.model import EV_Model
+
+
+def timed(phases, name, function):
+    """
+    Wraps function so the time spent in it is added to phases[name]
+    """
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        phases[name] += time.perf_counter() - start
+        return result
+    return wrapper
+
+
+def run(params, steps, warmup = 0):
+    """
+    Builds and runs a model, and returns the time of the construction and of every phase of the steps
+    (after warmup untimed steps, all EVs start out traveling)
+    """
+    phases = {"schedule": 0.0, "fleet": 0.0, "collect": 0.0, "respawn": 0.0}
+    start = time.perf_counter()
+    model = EV_Model(**params)
+    construction = time.perf_counter() - start
+    for i in range(warmup):
+        model.step()
+    model.schedule.step = timed(phases, "schedule", model.schedule.step)
+    if model.fleet is not None:
+        model.fleet.step = timed(phases, "fleet", model.fleet.step)
+    model.datacollector.collect = timed(phases, "collect", model.datacollector.collect)
+    model.stableAgents = timed(phases, "respawn", model.stableAgents)
+    start = time.perf_counter()
+    for i in range(steps):
+        model.step()
+    total = time.perf_counter() - start
+    return construction, total, phases
+
+
+def peak_memory(params, steps):
+    """
+    Returns the peak memory (bytes) of building the model and running the steps, measured in a separate run
+    because tracing the memory slows the model down
+    """
+    tracemalloc.start()
+    model = EV_Model(**params)
+    for i in range(steps):
+        model.step()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark(params, steps, repeats, memory = True, warmup = 0):
+    """
+    Returns the result of a single setting, the times are the best of repeats runs
+    """
+    best = None
+    for r in range(repeats):
+        construction, total, phases = run(params, steps, warmup)
+        if best is None or total < best[1]:
+            best = (construction, total, phases)
+    construction, total, phases = best
+    result = dict(params)
+    result.update({"steps": steps, "warmup": warmup, "construction_s": construction, "steps_s": total,
+                   "steps_per_s": steps / total, "agent_steps_per_s": steps * params["N"] / total,
+                   "phases_s": phases})
+    if memory:
+        result["peak_memory_bytes"] = peak_memory(params, steps)
+    return result
+
+
+def key(result):
+    # results written before skip_idle was benchmarked have no skip_idle, they ran without it
+    return tuple(result.get(name, False) for name in ("N", "width", "vision", "grid_positions", "open_grid", "engine", "skip_idle"))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore")
+    parser = argparse.ArgumentParser(description="Benchmark of EV_Model step throughput and scaling")
+    parser.add_argument("--N", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--size", type=int, nargs="+", default=[40, 100], help="width and height of the grid")
+    parser.add_argument("--vision", type=int, nargs="+", default=[2])
+    parser.add_argument("--grid-positions", nargs="+", default=["random", "circle", "big circle", "LHS"])
+    parser.add_argument("--open-grid", nargs="+", default=["True", "False"], choices=["True", "False"])
+    parser.add_argument("--engine", nargs="+", default=["agents"], choices=["agents", "vectorized"])
+    parser.add_argument("--skip-idle", nargs="+", default=["False"], choices=["True", "False"])
+    parser.add_argument("--n-poles", type=float, default=0.1)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=0, help="untimed steps before the timed steps")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slower) peak memory measurement")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare the steps per second with")
+    args = parser.parse_args()
+
+    results = []
+    print("%7s %5s %3s %11s %5s %10s %5s %8s %9s %13s %8s %8s" % ("N", "size", "vis", "positions", "open", "engine", "skip",
+                                                                     "build s", "steps/s", "agent-steps/s", "collect", "peak MB"))
+    for N, size, vision, positions, open_grid, engine, skip_idle in itertools.product(args.N, args.size, args.vision,
+                                                                                      args.grid_positions, args.open_grid,
+                                                                                      args.engine, args.skip_idle):
+        # open_grid has to be a bool, EV_Model only wraps the grid if open_grid == True
+        params = {"N": N, "width": size, "height": size, "n_poles": args.n_poles, "vision": vision,
+                  "grid_positions": positions, "open_grid": open_grid == "True", "engine": engine,
+                  "skip_idle": skip_idle == "True", "seed": args.seed}
+        result = benchmark(params, args.steps, args.repeats, not args.no_memory, args.warmup)
+        results.append(result)
+        print("%7d %5d %3d %11s %5s %10s %5s %8.2f %9.1f %13.0f %7.0f%% %8s" % (N, size, vision, positions, open_grid, engine, skip_idle,
+              result["construction_s"], result["steps_per_s"], result["agent_steps_per_s"],
+              100 * result["phases_s"]["collect"] / result["steps_s"],
+              "%.1f" % (result["peak_memory_bytes"] / 1e6) if "peak_memory_bytes" in result else "-"))
+
+    with open(args.output, "w") as f:
+        json.dump({"commit": git_commit(), "python": platform.python_version(), "machine": platform.machine(),
+                   "results": results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = {key(result): result for result in json.load(f)["results"]}
+        print("\nsteps per second compared to %s" % args.compare)
+        for result in results:
+            if key(result) in old:
+                print("%-55s %6.2fx" % (key(result), result["steps_per_s"] / old[key(result)]["steps_per_s"]))
@@ -0,0 +1,51 @@
+
+#memory_benchmark.py
+# Reports the memory used per EV by EV_Model, to see how many replicates fit on a node.
+# The grid is sized so every EV has 16 cells, and the memory of the grid itself (Mesa keeps a set per cell)
+# is reported separately. Usage: python memory_benchmark.py [--sizes 1000 10000 100000] [--steps 50]
+import argparse
+import gc
+import time
+import tracemalloc
+import warnings
+from EV.model import EV_Model
+
+
+def measure(N, steps, engine, cells_per_EV = 16, n_poles = 0.1):
+    """
+    Returns the memory of the grid, and the bytes per EV after construction and after the given number of steps
+    """
+    side = int((cells_per_EV * N) ** 0.5)
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    empty = EV_Model(N=1, width=side, height=side, n_poles=0, vision=2, engine=engine, seed=1)
+    grid = tracemalloc.get_traced_memory()[0] - start
+    del empty
+    gc.collect()
+    start = tracemalloc.get_traced_memory()[0]
+    model = EV_Model(N=N, width=side, height=side, n_poles=n_poles, vision=2, engine=engine, collect_every=0, seed=1)
+    built = tracemalloc.get_traced_memory()[0] - start
+    for i in range(steps):
+        model.step()
+    stepped = tracemalloc.get_traced_memory()[0] - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"N": N, "grid": side, "grid_bytes": grid, "bytes_per_EV": (built - grid) / N,
+            "bytes_per_EV_after_steps": (stepped - grid) / N, "peak_bytes": peak}
+
+
+if __name__ == "__main__":
+    warnings.simplefilter("ignore")
+    parser = argparse.ArgumentParser(description="Memory per EV of EV_Model")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--engine", default="agents", choices=["agents", "vectorized"])
+    args = parser.parse_args()
+
+    print("%8s %6s %10s %12s %18s %10s %8s" % ("N", "grid", "grid MB", "B per EV", "B per EV (steps)", "peak MB", "time"))
+    for N in args.sizes:
+        t = time.time()
+        result = measure(N, args.steps, args.engine)
+        print("%8d %6d %10.1f %12.0f %18.0f %10.1f %7.1fs" % (N, result["grid"], result["grid_bytes"] / 1e6, result["bytes_per_EV"],
+                                                            result["bytes_per_EV_after_steps"], result["peak_bytes"] / 1e6, time.time() - t))